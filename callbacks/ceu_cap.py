@@ -1,6 +1,10 @@
 # backend\solver\callbacks\ceu_cap.py
+import logging
+import numpy as np
 from ortools.constraint_solver import pywrapcp
 
+logger = logging.getLogger(__name__)
+
 
 def ceu_dimension(
     routing: pywrapcp.RoutingModel,
@@ -9,17 +13,26 @@ def ceu_dimension(
     ceu_cap: float,
 ):
     """Adiciona restrição de capacidade em CEU à rota."""
+    # lista python: acesso O(1) sem dispatch do pandas em cada chamada do solver
+    ceu = df.ceu_std.to_numpy(dtype=np.int64).tolist()
+    n = len(ceu)
 
     def demand(idx):
         try:
             node = manager.IndexToNode(idx)
-            if 0 <= node < len(df):
-                return int(df.ceu_std.iloc[node])
+            if 0 <= node < n:
+                return ceu[node]
         except Exception as e:
-            print(f"⚠️ Erro ao calcular demanda CEU para idx={idx}: {e}")
+            logger.error("⚠️ Erro ao calcular demanda CEU para idx=%s: %s", idx, e)
         return 0  # fallback seguro
 
-    demand_cb = routing.RegisterUnaryTransitCallback(demand)
+    if hasattr(routing, "RegisterUnaryTransitVector"):
+        # vetor indexado por nó: depósitos / nós extra ficam com demanda 0
+        n_nodes = manager.GetNumberOfNodes()
+        values = [ceu[node] if node < n else 0 for node in range(n_nodes)]
+        demand_cb = routing.RegisterUnaryTransitVector(values)
+    else:
+        demand_cb = routing.RegisterUnaryTransitCallback(demand)
     routing.AddDimensionWithVehicleCapacity(
         demand_cb,
         0,  # nenhum slack
@@ -1,10 +1,45 @@
+from typing import Any
+
+import numpy as np
+import pandas as pd
 from ortools.constraint_solver import pywrapcp
 
+from backend.solver.utils import node_index_array
+
 # manter um atributo escondido no modelo para lembrar-nos
 _TAG = "_disj_nodes"
 
+# seguradoras cujos serviços podem ficar por fazer com penalização baixa
+LOW_PRIORITY_INS = ("CONS", "PRC", "")
+
+
+def _used_nodes(routing: pywrapcp.RoutingModel) -> set[int]:
+    used: set[int] | None = getattr(routing, _TAG, None)
+    if used is None:
+        used = set()
+        setattr(routing, _TAG, used)
+    return used
+
 
 def interno_penalties(
+    routing: pywrapcp.RoutingModel,
+    manager: pywrapcp.RoutingIndexManager,
+    *args: Any,
+    **kwargs: Any,
+) -> None:
+    """
+    Ponto de entrada único para as penalizações de serviços opcionais:
+      • interno_penalties(routing, manager, pickup_ids, n_srv, weight=1000)
+      • interno_penalties(routing, manager, df, low_penalty, weight=1000)
+    """
+    first = args[0] if args else kwargs.get("df", kwargs.get("pickup_ids"))
+    if isinstance(first, pd.DataFrame):
+        _by_ins_short(routing, manager, *args, **kwargs)
+    else:
+        _by_pairs(routing, manager, *args, **kwargs)
+
+
+def _by_pairs(
     routing: pywrapcp.RoutingModel,
     manager: pywrapcp.RoutingIndexManager,
     pickup_ids: list[int],
@@ -16,19 +51,59 @@ def interno_penalties(
     tornamos o par opcional com penalização «weight».
 
     Se algum dos 2 nós já estiver noutra disjunction, saltamos.
+    A verificação usa só o set local (O(1)); o modelo nunca é consultado.
     """
-    if not hasattr(routing, _TAG):
-        setattr(routing, _TAG, set())
-    used: set[int] = getattr(routing, _TAG)
+    used = _used_nodes(routing)
 
-    for srv_id in pickup_ids:
-        p = manager.NodeToIndex(srv_id)
-        d = manager.NodeToIndex(srv_id + n_srv)
+    # resolve todos os pares de uma vez, com os métodos em variáveis locais
+    node_to_idx = node_index_array(manager)
+    n_nodes = len(node_to_idx)
+    add_disjunction = routing.AddDisjunction
+    pairs = [
+        (node_to_idx[s], node_to_idx[s + n_srv]) if 0 <= s and s + n_srv < n_nodes else (-1, -1)
+        for s in pickup_ids
+    ]
 
+    for p, d in pairs:
         if p < 0 or d < 0:  # nó inexistente
             continue
         if p in used or d in used:  # já foi usado noutro AddDisjunction
             continue
 
-        routing.AddDisjunction([p, d], weight)
-        used.update([p, d])  # marca como usado
+        add_disjunction([p, d], weight)
+        used.update((p, d))  # marca como usado
+
+
+def _by_ins_short(
+    routing: pywrapcp.RoutingModel,
+    manager: pywrapcp.RoutingIndexManager,
+    df: pd.DataFrame,
+    low_penalty: int,
+    weight: int = 1000,
+) -> None:
+    """
+    Torna opcional cada serviço (nó de pickup); seguradoras em LOW_PRIORITY_INS
+    ficam com «low_penalty», as restantes com «weight».
+    """
+    used = _used_nodes(routing)
+
+    node_to_idx = node_index_array(manager)
+    add_disjunction = routing.AddDisjunction
+
+    short = df["ins_short"]
+    if isinstance(short.dtype, pd.CategoricalDtype):
+        # compara só as categorias e propaga pelos códigos (NaN → "" → baixa prioridade)
+        special = np.isin(short.cat.categories.astype(str), LOW_PRIORITY_INS)
+        codes = short.cat.codes.to_numpy()
+        low = np.where(codes < 0, True, special[codes])
+    else:
+        low = np.isin(short.fillna("").astype(str).to_numpy(), LOW_PRIORITY_INS)
+    pens = np.where(low, low_penalty, weight).astype(int).tolist()
+
+    for node, pen in enumerate(pens[: len(node_to_idx)]):
+        idx = node_to_idx[node]
+        if idx < 0 or idx in used:
+            continue
+
+        add_disjunction([idx], pen)
+        used.add(idx)
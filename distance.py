@@ -1,42 +1,63 @@
 # backend/solver/distance.py
 
 from typing import Dict, Tuple, List
+from functools import lru_cache
 import unicodedata
 import logging
 from geopy.distance import geodesic  # type: ignore
+import numpy as np
 import pandas as pd 
 import csv
 import os
+import sqlite3
 from datetime import datetime, date
 from typing import Optional
 
+try:  # numba é opcional: sem ele usa-se o caminho numpy
+    from numba import njit, prange  # type: ignore
+except ImportError:  # pragma: no cover
+    njit = None
+
 # Cache de cidades inválidas
 _INVALID_CITY_LOG: List[Dict[str, str]] = []
 
 logger = logging.getLogger(__name__)
 
+# Raio médio da Terra (IUGG), em km
+EARTH_RADIUS_KM = 6371.0088
+
 # Cache interno de coordenadas: norm_name → (lat, lon)
 _COORDS_CACHE: Dict[str, Tuple[float, float]] = {}
 
+# Mesmas coordenadas em SoA (lat/lon em listas paralelas) para a matriz vetorizada
+_COORD_INDEX: Dict[str, int] = {}
+_LATS_LIST: List[float] = []
+_LONS_LIST: List[float] = []
+_RAD_ARRAYS: Optional[Tuple[np.ndarray, np.ndarray]] = None  # None = por reconstruir
+
+# Cache persistente de distâncias (só com DIST_PAIR_CACHE_PATH / load_pair_cache):
+# chave = par ordenado de coordenadas "lat,lon" → km, para não ficar obsoleta
+# quando register_coords muda as coordenadas de uma cidade
+PAIR_CACHE_PATH = os.getenv("DIST_PAIR_CACHE_PATH")
+_PAIR_TABLE_DDL = "CREATE TABLE IF NOT EXISTS dist_coords(a TEXT, b TEXT, km REAL, PRIMARY KEY(a, b))"
+_PAIR_CACHE: Dict[Tuple[str, str], float] = {}
+_PAIR_CACHE_NEW: Dict[Tuple[str, str], float] = {}
+_PAIR_CACHE_LOADED: Optional[str] = None
+
 
+@lru_cache(maxsize=8192)
 def _norm(texto: Optional[str]) -> str:
     if not isinstance(texto, str) or not texto.strip():
         return "DESCONHECIDA"
 
+    # já ASCII (caso comum: nomes já normalizados) → NFKD não altera nada
+    if texto.isascii():
+        return texto.upper().strip()
+
+    # NFKD + ASCII já remove os acentos; o resultado é sempre ASCII
     texto_normalizado = unicodedata.normalize("NFKD", texto)
     ascii_texto = texto_normalizado.encode("ASCII", "ignore").decode()
-    texto_maiusculo = ascii_texto.upper().strip()
-
-    return (
-        texto_maiusculo
-        .replace("Á", "A")
-        .replace("Ã", "A")
-        .replace("É", "E")
-        .replace("Í", "I")
-        .replace("Ó", "O")
-        .replace("Ú", "U")
-        .replace("Ç", "C")
-    )
+    return ascii_texto.upper().strip()
 
 
 def register_coords(coords_map: Dict[str, Tuple[float, float]]) -> None:
@@ -44,9 +65,21 @@ def register_coords(coords_map: Dict[str, Tuple[float, float]]) -> None:
     Popula o cache de coordenadas.
     coords_map: { nome_original: (lat, lon), ... }
     """
+    global _RAD_ARRAYS
     for city, coord in coords_map.items():
         norm_name = _norm(city)
         _COORDS_CACHE[norm_name] = coord
+
+        idx = _COORD_INDEX.get(norm_name)
+        if idx is None:
+            _COORD_INDEX[norm_name] = len(_LATS_LIST)
+            _LATS_LIST.append(float(coord[0]))
+            _LONS_LIST.append(float(coord[1]))
+        else:
+            _LATS_LIST[idx] = float(coord[0])
+            _LONS_LIST[idx] = float(coord[1])
+    if coords_map:
+        _RAD_ARRAYS = None
     logger.info(f"✅ Registradas {len(coords_map)} coordenadas no cache")
 
 
@@ -62,12 +95,79 @@ def _coords(city: str) -> Tuple[float, float]:
         )
     return _COORDS_CACHE[norm_name]
 
+
+def _coord_arrays() -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Arrays numpy (radianos) de lat/lon do cache, reconstruídos só após novos registos.
+    """
+    global _RAD_ARRAYS
+    if _RAD_ARRAYS is None:
+        _RAD_ARRAYS = (
+            np.radians(np.asarray(_LATS_LIST, dtype=np.float64)),
+            np.radians(np.asarray(_LONS_LIST, dtype=np.float64)),
+        )
+    return _RAD_ARRAYS
+
 def coordenada_real(row, tipo="load"):
     if row[f"{tipo}_is_base"] and pd.notnull(row["scheduled_base"]):
         return row["scheduled_base"]
     return row[f"{tipo}_city"]
 
 
+def _pair_key(a: str, b: str) -> Tuple[str, str]:
+    return (a, b) if a <= b else (b, a)
+
+
+def _coord_key(lat: float, lon: float) -> str:
+    return f"{lat:.6f},{lon:.6f}"
+
+
+def _pair_cache_enabled() -> bool:
+    return bool(_PAIR_CACHE_LOADED or PAIR_CACHE_PATH)
+
+
+def load_pair_cache(path: Optional[str] = None) -> None:
+    """
+    Carrega para _PAIR_CACHE as distâncias persistidas em sqlite (uma vez por path).
+    Sem path (nem DIST_PAIR_CACHE_PATH) não faz nada.
+    """
+    global _PAIR_CACHE_LOADED
+    path = path or PAIR_CACHE_PATH
+    if not path or _PAIR_CACHE_LOADED == path:
+        return
+
+    try:
+        with sqlite3.connect(path) as conn:
+            conn.execute(_PAIR_TABLE_DDL)
+            for a, b, km in conn.execute("SELECT a, b, km FROM dist_coords"):
+                _PAIR_CACHE[(a, b)] = km
+        _PAIR_CACHE_LOADED = path
+        logger.info(f"✅ {len(_PAIR_CACHE)} distâncias carregadas do cache {path}")
+    except sqlite3.Error as e:
+        logger.error(f"❌ Erro ao carregar cache de distâncias {path}: {e}")
+
+
+def save_pair_cache(path: Optional[str] = None) -> None:
+    """
+    Persiste em sqlite (INSERT OR IGNORE) os pares calculados desde o último save.
+    """
+    path = path or _PAIR_CACHE_LOADED or PAIR_CACHE_PATH
+    if not path or not _PAIR_CACHE_NEW:
+        return
+
+    try:
+        with sqlite3.connect(path) as conn:
+            conn.execute(_PAIR_TABLE_DDL)
+            conn.executemany(
+                "INSERT OR IGNORE INTO dist_coords(a, b, km) VALUES (?, ?, ?)",
+                [(a, b, km) for (a, b), km in _PAIR_CACHE_NEW.items()],
+            )
+        logger.debug(f"💾 {len(_PAIR_CACHE_NEW)} novas distâncias gravadas em {path}")
+        _PAIR_CACHE_NEW.clear()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Erro ao gravar cache de distâncias {path}: {e}")
+
+
 def _distance_km(a: Tuple[float, float], b: Tuple[float, float]) -> float:
     """
     Distância geodésica (geopy) entre dois pares (lat, lon), em km.
@@ -75,24 +175,126 @@ def _distance_km(a: Tuple[float, float], b: Tuple[float, float]) -> float:
     return geodesic(a, b).km  # type: ignore
 
 
-def build_distance_matrix(locations: List[str]) -> List[List[float]]:
+def _haversine_km_np(
+    lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray
+) -> np.ndarray:
+    """
+    Haversine vetorizado (em radianos) → km, elemento a elemento.
+    """
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+if njit is not None:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _haversine_matrix(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """
+        Kernel numba: percorre linha a linha o triângulo superior (radianos → km),
+        sem temporários n x n, e espelha para o inferior.
+        """
+        n = lat.shape[0]
+        out = np.zeros((n, n), dtype=np.float64)
+        cos_lat = np.cos(lat)
+        for i in prange(n):
+            for j in range(i + 1, n):
+                s_lat = np.sin((lat[j] - lat[i]) / 2)
+                s_lon = np.sin((lon[j] - lon[i]) / 2)
+                a = s_lat * s_lat + cos_lat[i] * cos_lat[j] * s_lon * s_lon
+                a = min(max(a, 0.0), 1.0)
+                d = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+                out[i, j] = d
+                out[j, i] = d
+        return out
+
+else:
+    _haversine_matrix = None
+
+
+def _full_matrix(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """
+    Matriz completa (radianos → km): kernel numba quando disponível, senão numpy
+    sobre o triângulo superior espelhado.
+    """
+    if _haversine_matrix is not None:
+        return _haversine_matrix(lat, lon)
+    n = lat.shape[0]
+    iu = np.triu_indices(n, 1)
+    mat = np.zeros((n, n), dtype=np.float64)
+    mat[iu] = _haversine_km_np(lat[iu[0]], lon[iu[0]], lat[iu[1]], lon[iu[1]])
+    mat += mat.T
+    return mat
+
+
+def _cached_matrix(idx: np.ndarray, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """
+    Caminho com cache persistente: reutiliza os pares já conhecidos (por coordenadas),
+    calcula só os em falta e grava-os no sqlite.
+    """
+    n = lat.shape[0]
+    keys = [_coord_key(_LATS_LIST[k], _LONS_LIST[k]) for k in idx.tolist()]
+    iu = np.triu_indices(n, 1)
+
+    cached = np.array(
+        [_PAIR_CACHE.get(_pair_key(keys[i], keys[j]), np.nan) for i, j in zip(*iu)],
+        dtype=np.float64,
+    )
+    missing = np.isnan(cached)
+    if not missing.any():
+        mat = np.zeros((n, n), dtype=np.float64)
+        mat[iu] = cached
+        mat += mat.T
+        return mat
+
+    if missing.all():
+        mat = _full_matrix(lat, lon)
+        cached = mat[iu]
+    else:
+        # Métrica simétrica: calcula só os pares em falta do triângulo superior e espelha
+        mi, mj = iu[0][missing], iu[1][missing]
+        cached[missing] = _haversine_km_np(lat[mi], lon[mi], lat[mj], lon[mj])
+        mat = np.zeros((n, n), dtype=np.float64)
+        mat[iu] = cached
+        mat += mat.T
+
+    for i, j, km in zip(iu[0][missing].tolist(), iu[1][missing].tolist(), cached[missing].tolist()):
+        key = _pair_key(keys[i], keys[j])
+        _PAIR_CACHE[key] = km
+        _PAIR_CACHE_NEW[key] = km
+    save_pair_cache()
+    return mat
+
+
+def build_distance_matrix(locations: List[str]) -> np.ndarray:
     """
     Constroi matriz de distâncias (float km) apenas para as 'locations' fornecidas.
     Antes de chamar este método, deve ter sido feito:
         register_coords({ cidade: (lat, lon), ... })
 
     locations: lista de nomes normalizados (ou que _norm converte).
-    Retorna: matriz n x n, onde mat[i][j] = km entre locations[i] e locations[j].
+    Retorna: matriz numpy n x n, onde mat[i][j] = km (haversine) entre
+    locations[i] e locations[j]. _distance_km (geodesic) fica como referência escalar.
     """
-    coords = [_coords(city) for city in locations]
-    n = len(coords)
-    mat: List[List[float]] = [[0.0] * n for _ in range(n)]
+    names = [_norm(city) for city in locations]
+    n = len(names)
+    try:
+        idx = np.fromiter((_COORD_INDEX[name] for name in names), dtype=np.intp, count=n)
+    except KeyError:
+        for city in locations:
+            _coords(city)  # lança ValueError com a cidade desconhecida
+        raise
+
+    lats, lons = _coord_arrays()
+    lat = lats[idx]
+    lon = lons[idx]
 
-    for i in range(n):
-        for j in range(n):
-            if i == j:
-                continue
-            mat[i][j] = _distance_km(coords[i], coords[j])
+    # por omissão: matriz inteira vetorizada/numba, sem trabalho por par em python
+    if _pair_cache_enabled():
+        mat = _cached_matrix(idx, lat, lon)
+    else:
+        mat = _full_matrix(lat, lon)
 
     logger.debug(f"➡️ Distância calculada para {n} locais (matriz {n}x{n})")
     return mat
@@ -1,8 +1,10 @@
 # backend/solver/geocode.py
 
 import os
+import asyncio
 import httpx
 import logging
+from typing import Dict, List, Tuple
 from sqlalchemy import text
 from urllib.parse import quote
 
@@ -14,48 +16,99 @@ TOMTOM_KEY = os.getenv("TOMTOM_API_KEY")
 TOMTOM_URL = "https://api.tomtom.com/search/2/geocode/{query}.json"
 
 
-async def fetch_and_store_city(sess, city: str) -> None:
+async def _geocode_tomtom(
+    cli: httpx.AsyncClient, sem: asyncio.Semaphore, city_norm: str
+) -> Tuple[float, float]:
     """
-    Consulta localmente a tabela city_coords.
-    Se não houver coordenadas, busca na API TomTom e persiste.
-    Sempre registra no cache interno da distância.
+    Geocodifica uma cidade na API TomTom (limitado pelo semáforo).
     """
-    city_norm = _norm(city)
+    query = f"{city_norm}, PORTUGAL" if "PORTUGAL" not in city_norm else city_norm
+    url = TOMTOM_URL.format(query=quote(query))
+    async with sem:
+        resp = await cli.get(url, params={"key": TOMTOM_KEY, "limit": 1})
+    resp.raise_for_status()
+    data = resp.json()
+    results = data.get("results", [])
+    if not results:
+        raise RuntimeError(f"TomTom não retornou coords para '{query}'")
+    return results[0]["position"]["lat"], results[0]["position"]["lon"]
+
 
-    # 1) Tenta buscar coordenadas locais já persistidas
+async def _select_coords(sess, norms: List[str]) -> Dict[str, Tuple[float, float]]:
+    """
+    Lê de city_coords, numa única query, as coordenadas das cidades pedidas.
+    """
+    if not norms:
+        return {}
     result = await sess.execute(
-        text("SELECT latitude, longitude FROM public.city_coords WHERE city_norm = :city"),
-        {"city": city_norm},
+        text(
+            "SELECT city_norm, latitude, longitude FROM public.city_coords "
+            "WHERE city_norm = ANY(:arr)"
+        ),
+        {"arr": list(norms)},
     )
-    row = result.first()
-
-    if row:
-        lat, lon = row
-        logger.debug(f"📍 Coordenadas existentes para {city_norm}: ({lat}, {lon})")
-    else:
-        # 2) Monta query e faz geocodificação
-        query = f"{city_norm}, PORTUGAL" if "PORTUGAL" not in city_norm else city_norm
-        url = TOMTOM_URL.format(query=quote(query))
-        resp = httpx.get(url, params={"key": TOMTOM_KEY, "limit": 1})
-        resp.raise_for_status()
-        data = resp.json()
-        results = data.get("results", [])
-        if not results:
-            raise RuntimeError(f"TomTom não retornou coords para '{query}'")
-        lat = results[0]["position"]["lat"]
-        lon = results[0]["position"]["lon"]
-        logger.info(f"🌐 Geocoded {city_norm} → ({lat}, {lon})")
+    return {city_norm: (lat, lon) for city_norm, lat, lon in result.all()}
+
+
+async def fetch_and_store_cities(
+    sess, cities: List[str], concurrency: int = 10
+) -> Dict[str, Tuple[float, float]]:
+    """
+    Versão em lote de fetch_and_store_city.
+    Consulta city_coords; as cidades em falta são geocodificadas em paralelo
+    (httpx.AsyncClient + semáforo) e persistidas num único executemany.
+    Regista tudo no cache interno e devolve { city_norm: (lat, lon) }.
+    Falhas de geocodificação são apenas logadas.
+    """
+    norms = list(dict.fromkeys(_norm(c) for c in cities))
+
+    # 1) Busca numa só query as coordenadas locais já persistidas
+    coords = await _select_coords(sess, norms)
+    missing = [city_norm for city_norm in norms if city_norm not in coords]
+    logger.debug(f"📍 Coordenadas existentes: {len(coords)}, em falta: {len(missing)}")
+
+    # 2) Geocodifica as restantes em paralelo
+    if missing:
+        sem = asyncio.Semaphore(concurrency)
+        async with httpx.AsyncClient(timeout=10) as cli:
+            results = await asyncio.gather(
+                *(_geocode_tomtom(cli, sem, city_norm) for city_norm in missing),
+                return_exceptions=True,
+            )
+
+        novos = []
+        for city_norm, res in zip(missing, results):
+            if isinstance(res, BaseException):
+                logger.warning(f"⚠️ Falha ao geocodificar {city_norm}: {res}")
+                continue
+            lat, lon = res
+            logger.info(f"🌐 Geocoded {city_norm} → ({lat}, {lon})")
+            coords[city_norm] = (lat, lon)
+            novos.append({"city": city_norm, "lat": lat, "lon": lon})
 
         # 3) Persiste na base
-        await sess.execute(
-            text("""
-                INSERT INTO public.city_coords(city_norm, latitude, longitude)
-                VALUES (:city, :lat, :lon)
-                ON CONFLICT (city_norm) DO NOTHING
-            """),
-            {"city": city_norm, "lat": lat, "lon": lon},
-        )
-        await sess.commit()
+        if novos:
+            await sess.execute(
+                text("""
+                    INSERT INTO public.city_coords(city_norm, latitude, longitude)
+                    VALUES (:city, :lat, :lon)
+                    ON CONFLICT (city_norm) DO NOTHING
+                """),
+                novos,
+            )
+            await sess.commit()
 
     # 4) Registra no cache interno
-    register_coords({city_norm: (lat, lon)})
+    register_coords(coords)
+    return coords
+
+
+async def fetch_and_store_city(sess, city: str) -> None:
+    """
+    Consulta localmente a tabela city_coords.
+    Se não houver coordenadas, busca na API TomTom e persiste.
+    Sempre registra no cache interno da distância.
+    """
+    coords = await fetch_and_store_cities(sess, [city], concurrency=1)
+    if _norm(city) not in coords:
+        raise RuntimeError(f"Não foi possível obter coordenadas para '{city}'")
@@ -2,51 +2,56 @@
 from datetime import date
 from typing import Optional
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import text
+from sqlalchemy import Date, bindparam, text
 from sqlalchemy.ext.asyncio import AsyncSession
 import logging
 
 logger = logging.getLogger(__name__)
 
+_SQL_ELIGIBLE_SERVICES = text(
+    """
+    SELECT
+        id,
+        campos->>'matricula' AS registry,
+        campos->'load_city'->>'description' AS load_city_description,
+        campos->'unload_city'->>'description' AS unload_city_description,
+        campos->>'expected_delivery_date' AS expected_delivery_date,
+        campos->>'expected_delivery_date_manual' AS expected_delivery_date_manual,
+        COALESCE(
+            (campos->>'expected_delivery_date_manual')::date,
+            (campos->>'expected_delivery_date')::date
+        ) AS due_date,
+        campos->>'ceu' AS ceu_raw,
+        campos->'insurance_company'->>'short_name' AS insurance_company_short_name,
+        campos->'vehicle_category'->>'name' AS vehicle_category_name
+    FROM ids_monitorados
+    WHERE campos->'state'->>'id' IN ('P','PA','A','S','AM')
+      AND campos->'service_category'->>'id' IN (
+          '8','10','12','13','19','25','27','28','29',
+          '33','37','48','50','85','86'
+      )
+      AND COALESCE(
+          (campos->>'expected_delivery_date_manual')::date,
+          (campos->>'expected_delivery_date')::date
+      ) <= :dia
+    """
+).bindparams(bindparam("dia", type_=Date))
+
 
 async def load_dataframe(sess: AsyncSession, dia: date) -> Optional[pd.DataFrame]:
     """
     Extrai os serviços elegíveis até o dia informado.
     Aplica normalização e enriquece com colunas derivadas.
     """
-    sql = text(
-        """
-        SELECT
-            id,
-            campos->>'matricula' AS registry,
-            campos->'load_city'->>'description' AS load_city_description,
-            campos->'unload_city'->>'description' AS unload_city_description,
-            campos->>'expected_delivery_date' AS expected_delivery_date,
-            campos->>'expected_delivery_date_manual' AS expected_delivery_date_manual,
-            campos->>'ceu' AS ceu_raw,
-            campos->'insurance_company'->>'short_name' AS insurance_company_short_name,
-            campos->'vehicle_category'->>'name' AS vehicle_category_name
-        FROM ids_monitorados
-        WHERE campos->'state'->>'id' IN ('P','PA','A','S','AM')
-          AND campos->'service_category'->>'id' IN (
-              '8','10','12','13','19','25','27','28','29',
-              '33','37','48','50','85','86'
-          )
-          AND COALESCE(
-              (campos->>'expected_delivery_date_manual')::date,
-              (campos->>'expected_delivery_date')::date
-          ) <= :dia
-        """
-    )
-
-    result = await sess.execute(sql, {"dia": dia})
-    rows = result.fetchall()
+    result = await sess.execute(_SQL_ELIGIBLE_SERVICES, {"dia": dia})
+    rows = result.mappings().all()
     if not rows:
         logger.warning("Nenhum serviço elegível encontrado para %s", dia)
         return None
 
-    df = pd.DataFrame(rows, columns=list(result.keys()))
+    df = pd.DataFrame.from_records(rows)
 
     # Renomear para consistência
     df.rename(
@@ -58,32 +63,23 @@ async def load_dataframe(sess: AsyncSession, dia: date) -> Optional[pd.DataFrame
     )
 
     # CEU: prioriza campo explícito, senão infere por categoria
-    def compute_ceu(row) -> float:
-        try:
-            ceu_val = float(row.get("ceu_raw") or 0)
-            if ceu_val > 0:
-                return ceu_val
-        except Exception:
-            pass
-
-        name = (row.get("vehicle_category_name") or "").lower()
-        if "moto" in name:
-            return 0.3
-        if "furg" in name or "rodado" in name:
-            return 1.5
-        return 1.0
+    ceu_raw = pd.to_numeric(df["ceu_raw"], errors="coerce").fillna(0)
+    name = df["vehicle_category_name"].fillna("").astype(str).str.lower()
+    ceu_cat = np.select(
+        [name.str.contains("moto"), name.str.contains("furg|rodado")],
+        [0.3, 1.5],
+        default=1.0,
+    )
+    df["ceu"] = np.where(ceu_raw > 0, ceu_raw, ceu_cat)
 
-    df["ceu"] = df.apply(compute_ceu, axis=1)
+    # Data final esperada (já resolvida e tipada em SQL)
+    df["due"] = pd.to_datetime(df["due_date"])
 
-    # Data final esperada
-    df["due"] = pd.to_datetime(
-        df.expected_delivery_date_manual.fillna(df.expected_delivery_date),
-        errors="coerce",
+    # Código curto da seguradora (poucos valores distintos → categórico)
+    df["ins_short"] = (
+        df.insurance_company_short_name.fillna("").str.upper().str.slice(0, 4).astype("category")
     )
 
-    # Código curto da seguradora
-    df["ins_short"] = df.insurance_company_short_name.fillna("").str.upper().str[:4]
-
     return df
 
 
@@ -126,4 +122,4 @@ async def load_constraint_weights(sess: AsyncSession) -> dict[str, float]:
         """
     )
     result = await sess.execute(sql)
-    return {row.cod: float(row.valor) for row in result.fetchall()}
+    return {row["cod"]: float(row["valor"]) for row in result.mappings()}
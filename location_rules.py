@@ -3,87 +3,135 @@ Regras para mapear cidades-base e forçar retorno dos serviços.
 Compatível com OR-Tools 9.7 (não usa SetAllowedTransitEdgesForNode).
 """
 
-from typing import Dict
+import asyncio
+import os
+import time
+import weakref
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Optional, Tuple
 import logging
+import numpy as np
 import pandas as pd
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from ortools.constraint_solver import pywrapcp
-from backend.solver.utils import norm
+from backend.solver.utils import norm_series, node_index_array
 
 logger = logging.getLogger(__name__)
 
+# cache do mapa cidade → base, por engine, válido durante CITY_BASE_TTL_SEC
+# (dados de referência quase estáticos: o TTL pode ser alargado por env em produção)
+CITY_BASE_TTL_SEC = float(os.getenv("CITY_BASE_TTL_SEC", "60"))
+_CITY_BASE_CACHE: Dict[Any, Tuple[float, Dict[str, str]]] = {}
+# um lock por event loop (criado à primeira utilização): um asyncio.Lock global
+# ficaria preso ao 1.º loop e falharia com asyncio.run por job / testes / workers
+_CITY_BASE_LOCKS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _city_base_lock() -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    lock = _CITY_BASE_LOCKS.get(loop)
+    if lock is None:
+        lock = _CITY_BASE_LOCKS[loop] = asyncio.Lock()
+    return lock
+
 
 # ───────────────────────── helpers BD ──────────────────────────────────────────
-async def fetch_city_base_map(sess: AsyncSession) -> Dict[str, str]:
-    q = await sess.execute(
-        text(
-            """
-            SELECT city_norm, base_norm
-              FROM rule_return_city
-             WHERE base_norm IS NOT NULL
-            """
+async def fetch_city_base_map(sess: AsyncSession, *, refresh: bool = False) -> Dict[str, str]:
+    """
+    Mapa city_norm → base_norm de rule_return_city.
+    Fica em cache por engine durante CITY_BASE_TTL_SEC; a sessão só é usada num miss.
+    """
+    key = getattr(sess, "bind", None)
+    async with _city_base_lock():
+        hit = _CITY_BASE_CACHE.get(key)
+        if hit is not None and not refresh and time.monotonic() - hit[0] < CITY_BASE_TTL_SEC:
+            return hit[1]
+
+        q = await sess.execute(
+            text(
+                """
+                SELECT city_norm, base_norm
+                  FROM rule_return_city
+                 WHERE base_norm IS NOT NULL
+                """
+            )
         )
-    )
-    return {r.city_norm: r.base_norm for r in q}
+        city_to_base = dict(q.all())  # pares (city_norm, base_norm)
+        _CITY_BASE_CACHE[key] = (time.monotonic(), city_to_base)
+        return city_to_base
 
 
 # ───────────────────── rewrites P8 / P9 ────────────────────────────────────────
-async def rewrite_load_city_if_return(df: pd.DataFrame, sess: AsyncSession) -> None:
-    city_to_base = await fetch_city_base_map(sess)
-
-    def override(row: pd.Series) -> str:
-        trailer = str(row.get("vehicle_category_name", "")).upper()
-        cur = str(row.get("load_city", ""))
-        return (
-            city_to_base.get(norm(cur), cur)
-            if trailer.startswith(("P8", "P9"))
-            else cur
-        )
+def _override_city_column(df: pd.DataFrame, col: str, city_to_base: Dict[str, str]) -> pd.Series:
+    """
+    Para trailers P8/P9 troca a cidade pela base correspondente (se existir).
+    """
+    trailer = df["vehicle_category_name"].astype(str).str.upper()
+    mask = trailer.str.startswith("P8") | trailer.str.startswith("P9")
 
-    df["orig_load_city"] = df["load_city"]
-    df["load_city"] = df.apply(override, axis=1)
+    cur = df[col].astype(str)
 
+    # normaliza/mapeia só os valores distintos e propaga com uma LUT
+    uniq = pd.Series(cur.unique())
+    lut = dict(zip(uniq, norm_series(uniq).map(city_to_base).fillna(uniq)))
+    return cur.where(~mask, cur.map(lut))
 
-async def rewrite_unload_city_if_return(df: pd.DataFrame, sess: AsyncSession) -> None:
-    city_to_base = await fetch_city_base_map(sess)
 
-    def override(row: pd.Series) -> str:
-        trailer = str(row.get("vehicle_category_name", "")).upper()
-        cur = str(row.get("unload_city", ""))
-        return (
-            city_to_base.get(norm(cur), cur)
-            if trailer.startswith(("P8", "P9"))
-            else cur
-        )
+async def rewrite_load_city_if_return(
+    df: pd.DataFrame,
+    sess: AsyncSession,
+    city_to_base: Optional[Dict[str, str]] = None,
+) -> None:
+    if city_to_base is None:
+        city_to_base = await fetch_city_base_map(sess)
+
+    df["orig_load_city"] = df["load_city"]
+    df["load_city"] = _override_city_column(df, "load_city", city_to_base)
+
+
+async def rewrite_unload_city_if_return(
+    df: pd.DataFrame,
+    sess: AsyncSession,
+    city_to_base: Optional[Dict[str, str]] = None,
+) -> None:
+    if city_to_base is None:
+        city_to_base = await fetch_city_base_map(sess)
 
     df["orig_unload_city"] = df["unload_city"]
-    df["unload_city"] = df.apply(override, axis=1)
+    df["unload_city"] = _override_city_column(df, "unload_city", city_to_base)
 
 
 # ─────────────────── força retorno com Element() ──────────────────────────────
 def add_force_return_constraints(routing, manager, df, n_srv):
-    solver = routing.solver()
+    node_to_idx = node_index_array(manager)
+    next_var_of = routing.NextVar
 
-    for i in range(n_srv):
-        if not df["force_return"].iat[i]:
-            continue
+    # ends ordenados (índice End → veículo) para recortar por [Min, Max] com bisect
+    end_vehicle = sorted((routing.End(v), v) for v in range(routing.vehicles()))
+    end_values = [e for e, _ in end_vehicle]
 
-        drop = manager.NodeToIndex(i + n_srv)
+    # só os serviços com retorno forçado, sem .iat por linha
+    force = df["force_return"].to_numpy(dtype=bool)[:n_srv]
+
+    for i in np.flatnonzero(force).tolist():
+        node = i + n_srv
+        drop = node_to_idx[node] if node < len(node_to_idx) else -1
         if drop < 0:
             continue  # nó removido
 
-        next_var = routing.NextVar(drop)
-        vehicle_var = routing.VehicleVar(drop)
+        next_var = next_var_of(drop)
 
         # usa apenas intervalos Min/Max  -->  nunca chama Contains()
         lo, hi = next_var.Min(), next_var.Max()
+        first, last = bisect_left(end_values, lo), bisect_right(end_values, hi)
+        candidates = end_vehicle[first:last]
+        if not candidates:
+            continue
 
-        for v in range(routing.vehicles()):
-            end_v = routing.End(v)
-            if end_v < lo or end_v > hi:
-                continue  # fora do domínio
-
-            b_v = solver.IsEqualCstVar(vehicle_var, v)
-            b_end = solver.IsEqualCstVar(next_var, end_v)
-            solver.Add(b_v <= b_end)  # (b_v ⇒ b_end)
+        # após o drop só pode vir um End (ou o próprio nó, se ficar inativo).
+        # O modelo já liga NextVar = End(v) a VehicleVar = v, por isso basta o
+        # domínio: sem IsEqualCstVar/solver.Add por veículo candidato
+        next_var.SetValues([end_v for end_v, _ in candidates] + [drop])
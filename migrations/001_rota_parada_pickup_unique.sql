@@ -0,0 +1,14 @@
+-- backend/solver/migrations/001_rota_parada_pickup_unique.sql
+-- Um serviço só pode ter um PICKUP em rota_parada.
+-- optimizer/persist_results.py insere os PICKUP com
+--   ON CONFLICT (service_id) WHERE node_type = 'PICKUP' DO NOTHING RETURNING service_id
+-- quando este índice existe e está válido; sem ele cai para um SELECT prévio
+-- dos PICKUP existentes, sem proteção contra escritas concorrentes.
+--
+-- CONCURRENTLY não corre dentro de transação: aplicar fora de BEGIN/COMMIT.
+-- Se existirem PICKUP duplicados o índice fica INVALID; limpar os duplicados,
+-- fazer DROP INDEX ux_rota_parada_service_pickup e voltar a aplicar.
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ux_rota_parada_service_pickup
+    ON rota_parada (service_id)
+    WHERE node_type = 'PICKUP';
@@ -0,0 +1,18 @@
+-- backend/solver/migrations/002_ids_monitorados_eligible_index.sql
+-- Índice parcial dos serviços elegíveis para o solver (optimizer/prepare_input.py).
+-- O predicado tem de ser textualmente o mesmo de _ELIGIBLE_PREDICATE para o
+-- planner provar que o índice cobre a consulta; a data COALESCE(...::date) fica
+-- de fora porque o cast text→date não é IMMUTABLE.
+--
+-- CONCURRENTLY não corre dentro de transação: aplicar fora de BEGIN/COMMIT.
+-- Se a construção falhar o índice fica INVALID e IF NOT EXISTS não o refaz:
+-- DROP INDEX CONCURRENTLY ix_ids_monitorados_elegiveis e voltar a aplicar.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ids_monitorados_elegiveis
+    ON ids_monitorados (id)
+    WHERE
+        campos->'state'->>'id' IN ('P','PA','A','S','AM')
+      AND campos->'service_category'->>'id' IN (
+            '8','10','12','13','19','25','27','28','29',
+            '33','37','48','50','85','86'
+        );
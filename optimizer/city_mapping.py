@@ -3,7 +3,10 @@
 from typing import List, Tuple, Dict, Any
 import logging
 
-from backend.solver.utils import norm, haversine_km
+import numpy as np
+import pandas as pd
+
+from backend.solver.utils import norm, norm_series, haversine_km
 from backend.solver.distance import build_distance_matrix as _build_distance_matrix
 import math
 
@@ -16,25 +19,21 @@ def get_unique_cities(df, trailers: List[Dict[str, Any]]) -> List[str]:
     e das cidades base dos trailers.
     """
     # 1) Extrai as cidades de carregamento e descarga
-    load_cities = df["load_city"].dropna().astype(str).tolist()
-    unload_cities = df["unload_city"].dropna().astype(str).tolist()
+    load_cities = df["load_city"].dropna().astype(str)
+    unload_cities = df["unload_city"].dropna().astype(str)
 
     # 2) Extrai as cidades base dos trailers
-    base_cities = [
-        t.get("base_city", "").strip() for t in trailers if t.get("base_city")
-    ]
+    base_cities = pd.Series(
+        [t.get("base_city", "").strip() for t in trailers if t.get("base_city")],
+        dtype=object,
+    )
 
     # 3) Normaliza todos os nomes
-    all_cities = load_cities + unload_cities + base_cities
-    normalized = [norm(city) for city in all_cities if city]
+    all_cities = pd.concat([load_cities, unload_cities, base_cities], ignore_index=True)
+    normalized = norm_series(all_cities[all_cities != ""])
 
-    # 4) Remove duplicados mantendo ordem de primeira aparição
-    seen = set()
-    unique_cities: List[str] = []
-    for city in normalized:
-        if city not in seen:
-            seen.add(city)
-            unique_cities.append(city)
+    # 4) Remove duplicados mantendo ordem de primeira aparição (hash em C)
+    unique_cities: List[str] = pd.unique(normalized.to_numpy()).tolist()
 
     logger.info(f"📍 Cidades únicas normalizadas: {unique_cities}")
     logger.debug(f"🔢 Total: {len(unique_cities)} cidades")
@@ -86,8 +85,9 @@ def build_city_index_and_matrix(
     # 3) Constrói matriz de distâncias em float
     dist_f = _build_distance_matrix(locations)
 
-    # 4) Converte distâncias para inteiros (km arredondados)
-    distance_matrix: List[List[int]] = [[int(round(d)) for d in row] for row in dist_f]
+    # 4) Converte distâncias para inteiros (km arredondados) em numpy;
+    #    .tolist() devolve int python, como esperado pelo OR-Tools e validações
+    distance_matrix: List[List[int]] = np.rint(np.asarray(dist_f)).astype(np.int64).tolist()
 
     logger.info(f"🌍 Cidades únicas: {len(locations)}")
     logger.debug(
@@ -1,7 +1,9 @@
 # backend/solver/optimizer/cluster.py
 
-from sklearn.cluster import KMeans
-from backend.solver.distance import coordenada_real, get_coords, _norm
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from backend.solver.distance import get_coords
+from backend.solver.utils import norm_series
 import pandas as pd
 import logging
 
@@ -14,25 +16,40 @@ def agrupar_por_cluster_geografico(df: pd.DataFrame, n_clusters: int = 5, tipo:
     """
     assert tipo in {"load", "unload"}, "tipo deve ser 'load' ou 'unload'"
 
-    # Coordenadas reais respeitando scheduled_base
-    real_cidades = df.apply(lambda r: coordenada_real(r, tipo), axis=1)
-    norm_cidades = real_cidades.apply(_norm)
+    # Coordenadas reais respeitando scheduled_base (mesma regra de coordenada_real)
+    use_base = df[f"{tipo}_is_base"].fillna(False).astype(bool) & df["scheduled_base"].notna()
+    real_cidades = df[f"{tipo}_city"].where(~use_base, df["scheduled_base"])
+    norm_cidades = norm_series(real_cidades)
 
-    coords = norm_cidades.apply(get_coords)
-    valid_coords = coords[coords.notnull()].tolist()
-    indices_validos = coords[coords.notnull()].index
+    # uma consulta ao cache por cidade distinta, propagada pelos códigos
+    codes, uniq = pd.factorize(norm_cidades)
+    uniq_coords = [get_coords(city) for city in uniq]
+    uniq_valid = np.array([c is not None for c in uniq_coords], dtype=bool)
+    uniq_arr = np.array([c if c is not None else (np.nan, np.nan) for c in uniq_coords], dtype=np.float32).reshape(-1, 2)
+
+    valid_mask = (codes >= 0) & uniq_valid[codes] if len(uniq) else np.zeros(len(codes), dtype=bool)
+    valid_coords = uniq_arr[codes[valid_mask]]
 
     if len(valid_coords) < n_clusters:
         logger.warning(f"⚠️ Apenas {len(valid_coords)} com coordenadas → usando {len(valid_coords)} clusters")
         n_clusters = max(1, len(valid_coords))
 
-    coords_df = pd.DataFrame(valid_coords, columns=["lat", "lng"])
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42).fit(coords_df)
-
-    # Associa cluster ao DataFrame original
-    df_clusterizado = df.copy()
-    df_clusterizado.loc[indices_validos, "geo_cluster"] = kmeans.labels_
-
-    # Retorna grupos não vazios
-    grupos = [g for _, g in df_clusterizado.groupby("geo_cluster") if not g.empty]
+    coords_arr = np.ascontiguousarray(valid_coords)
+    kmeans = MiniBatchKMeans(
+        n_clusters=n_clusters,
+        random_state=42,
+        batch_size=max(1, min(256, len(coords_arr))),
+        n_init=1 if len(coords_arr) < 256 else "auto",
+    ).fit(coords_arr)
+
+    # Label por linha (-1 = sem coordenadas), sem copiar o DataFrame
+    labels = np.full(len(df), -1, dtype=np.int32)
+    labels[valid_mask] = kmeans.labels_
+
+    # Retorna grupos não vazios, por ordem de cluster
+    grupos = []
+    for c in range(n_clusters):
+        pos = np.flatnonzero(labels == c)
+        if len(pos):
+            grupos.append(df.iloc[pos])
     return grupos
\ No newline at end of file
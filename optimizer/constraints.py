@@ -1,5 +1,7 @@
 #/app/backend/solver/optimizer/constraints.py
-from typing import List
+import logging
+from typing import List, Optional
+import numpy as np
 import pandas as pd
 from ortools.constraint_solver import pywrapcp
 
@@ -8,7 +10,72 @@ from backend.solver.routing import (
     add_dimensions_and_constraints,
 )
 
-from backend.solver.utils import norm
+from backend.solver.utils import norm_series, node_index_array
+
+logger = logging.getLogger(__name__)
+
+
+def _resolve_pickup_delivery_pairs(
+    df: pd.DataFrame,
+    manager: pywrapcp.RoutingIndexManager,
+    city_index_map: dict[str, int],
+) -> dict[tuple[int, int], int]:
+    """
+    Resolve, sem tocar no modelo, os pares (pickup_idx, delivery_idx) do solver.
+    city_index_map é o do modelo (build_city_index_and_matrix), nunca re-derivado aqui.
+    Pares repetidos (mesmas cidades) ficam uma só vez, com a 1.ª linha do df.
+    """
+    # normalização feita uma vez por cidade distinta
+    loads = norm_series(df["load_city"]).to_numpy()
+    unloads = norm_series(df["unload_city"]).to_numpy()
+
+    # serviços internos (load = unload) não geram par: comparação numa só passagem
+    externos = loads != unloads
+
+    node_to_idx = np.asarray(node_index_array(manager), dtype=np.int64)
+    n_nodes = len(node_to_idx)
+    p_nodes = pd.Series(loads).map(city_index_map).to_numpy(dtype=float)
+    d_nodes = pd.Series(unloads).map(city_index_map).to_numpy(dtype=float)
+
+    valid = ~np.isnan(p_nodes) & ~np.isnan(d_nodes)
+    valid &= np.where(valid, np.maximum(p_nodes, d_nodes), 0) < n_nodes
+    invalidos = df.index[externos & ~valid]
+    if len(invalidos):
+        logger.error("❌ Erro aplicando pickup-delivery: linhas sem nó de cidade %s", invalidos.tolist())
+
+    ok = externos & valid
+    p_idx = node_to_idx[p_nodes[ok].astype(np.int64)].tolist()
+    d_idx = node_to_idx[d_nodes[ok].astype(np.int64)].tolist()
+    pairs: dict[tuple[int, int], int] = {}
+    for i, pair in zip(df.index[ok], zip(p_idx, d_idx)):
+        pairs.setdefault(pair, i)
+    return pairs
+
+
+def _add_pickup_delivery_pairs(
+    routing: pywrapcp.RoutingModel,
+    pairs: dict[tuple[int, int], int],
+) -> None:
+    """
+    Aplica ao modelo os pares já resolvidos (mesmo veículo + pickup antes da entrega).
+    A ordem fica a cargo da restrição de precedência nativa do routing, que os
+    operadores de pesquisa local conhecem, em vez de um CumulVar(p) <= CumulVar(d) genérico.
+    """
+    add_pickup_delivery = routing.AddPickupAndDelivery
+
+    for (p_idx, d_idx), i in pairs.items():
+        if p_idx < 0 or d_idx < 0 or p_idx == d_idx:
+            continue
+        try:
+            # AddPickupAndDelivery obriga ao mesmo veículo e a pickup antes da entrega
+            add_pickup_delivery(p_idx, d_idx)
+        except Exception as e:
+            logger.error("❌ Erro aplicando pickup-delivery para linha %s: %s", i, e)
+
+    # sem LIFO/FIFO entre pares: só a precedência de cada par
+    routing.SetPickupAndDeliveryPolicyOfAllVehicles(
+        pywrapcp.RoutingModel.PICKUP_AND_DELIVERY_NO_ORDER
+    )
 
 
 def apply_all_constraints(
@@ -18,40 +85,22 @@ def apply_all_constraints(
     trailers: List[dict],
     n_services: int,
     depot_indices: List[int],
-    distance_matrix: List[List[int]],  # ainda não usado
     constraint_weights: dict[str, float],
     *,
+    city_index_map: dict[str, int],
     enable_pickup_pairs: bool = True,
+    distance_matrix: Optional[List[List[int]]] = None,
 ) -> None:
-    from backend.solver.optimizer.city_mapping import map_city_indices
-
+    """
+    Capacidade CEU + pares pickup/delivery.
+    distance_matrix é ignorado (obsoleto): o custo de distância já está no modelo.
+    """
     # Capacidade (CEU)
     cb_indices, _ = create_demand_callbacks(df, manager, routing, depot_indices)
     add_dimensions_and_constraints(routing, trailers, cb_indices)
 
-    if not enable_pickup_pairs:
+    if not enable_pickup_pairs or n_services == 0:
         return
 
-    ceu_dim = routing.GetDimensionOrDie("CEU")
-
-    # Mapeamento cidades → índices
-    all_cities = df["load_city"].tolist() + df["unload_city"].tolist()
-    all_cities = list({c for c in all_cities if isinstance(c, str)})
-    city_index_map = map_city_indices([c.upper().strip() for c in all_cities])
-
-    for i, row in df.iterrows():
-        load = row["load_city"]
-        unload = row["unload_city"]
-
-        try:
-            p_node = city_index_map[norm(load)]
-            d_node = city_index_map[norm(unload)]
-
-            p_idx = manager.NodeToIndex(p_node)
-            d_idx = manager.NodeToIndex(d_node)
-
-            routing.AddPickupAndDelivery(p_idx, d_idx)
-            routing.solver().Add(routing.VehicleVar(p_idx) == routing.VehicleVar(d_idx))
-            routing.solver().Add(ceu_dim.CumulVar(p_idx) <= ceu_dim.CumulVar(d_idx))
-        except Exception as e:
-            print(f"❌ Erro aplicando pickup-delivery para linha {i}: {e}")
\ No newline at end of file
+    pairs = _resolve_pickup_delivery_pairs(df, manager, city_index_map)
+    _add_pickup_delivery_pairs(routing, pairs)
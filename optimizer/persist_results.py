@@ -1,139 +1,352 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import text
-from typing import List, Tuple, Dict, Any, Optional
+from sqlalchemy import bindparam, delete, insert, select, text, update
+from typing import List, Tuple, Dict, Any, Optional, Set
 import logging
+import numpy as np
 import pandas as pd
 from datetime import date
 
+from backend.models.rota import Rota, RotaParada
+
 logger = logging.getLogger(__name__)
 
+PARADA_COLUMNS = ("rota_id", "ordem", "service_id", "node_type")
 
-async def persist_routes(
+# um serviço só pode ter um PICKUP em rota_parada: índice único parcial
+# (migrations/001_rota_parada_pickup_unique.sql); sem ele, ou fora do PostgreSQL,
+# a mesma regra é aplicada com um SELECT prévio
+PICKUP_INDEX = "ux_rota_parada_service_pickup"
+_PICKUP_INDEX_OK: Optional[bool] = None
+
+# o caminho rápido (COPY binário) só existe com postgresql+asyncpg
+COPY_DRIVER = "asyncpg"
+_WARNED_NO_COPY = False
+
+_rota_tbl = Rota.__table__
+_parada_tbl = RotaParada.__table__
+
+INSERT_ROTA = insert(_rota_tbl).returning(_rota_tbl.c.id, sort_by_parameter_order=True)
+INSERT_PARADA = insert(_parada_tbl)
+DELETE_ROTAS = delete(_rota_tbl).where(_rota_tbl.c.id.in_(bindparam("rota_ids", expanding=True)))
+UPDATE_ROTA_CEU = (
+    update(_rota_tbl)
+    .where(_rota_tbl.c.id == bindparam("b_id"))
+    .values(total_ceu=bindparam("b_total_ceu"))
+)
+# sem COPY mas em PostgreSQL: as paragens seguem como 4 arrays e o servidor faz o unnest
+_UNNEST_PARADAS = """
+    INSERT INTO rota_parada (rota_id, ordem, service_id, node_type)
+    SELECT * FROM unnest(
+        CAST(:rota_ids AS bigint[]), CAST(:ordens AS integer[]),
+        CAST(:service_ids AS bigint[]), CAST(:node_types AS text[])
+    )
+"""
+INSERT_PARADAS_UNNEST = text(_UNNEST_PARADAS)
+# PICKUP já existente noutra rota não entra; o RETURNING diz quais entraram
+INSERT_PICKUPS_RETURNING = text(
+    _UNNEST_PARADAS
+    + "    ON CONFLICT (service_id) WHERE node_type = 'PICKUP' DO NOTHING\n"
+    + "    RETURNING service_id\n"
+)
+SELECT_PICKUP_INDEX_VALID = text(
+    "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(CAST(:nome AS text))"
+)
+SELECT_PICKUPS_EXISTENTES = (
+    select(_parada_tbl.c.service_id)
+    .where(_parada_tbl.c.node_type == "PICKUP")
+    .where(_parada_tbl.c.service_id.in_(bindparam("service_ids", expanding=True)))
+)
+UPDATE_SERVICE_ROTA = text(
+    """
+    UPDATE ids_monitorados AS im
+    SET rota_id = v.rota_id
+    FROM unnest(CAST(:service_ids AS bigint[]), CAST(:rota_ids AS bigint[]))
+         AS v(service_id, rota_id)
+    WHERE im.id = v.service_id AND im.rota_id IS NULL
+    """
+)
+
+
+def _unnest_params(records: List[Tuple[int, int, int, str]]) -> Dict[str, list]:
+    rota_ids, ordens, service_ids, node_types = (list(col) for col in zip(*records))
+    return {
+        "rota_ids": rota_ids,
+        "ordens": ordens,
+        "service_ids": service_ids,
+        "node_types": node_types,
+    }
+
+
+async def _pickup_index_ok(sess: AsyncSession) -> bool:
+    """Verifica (uma vez por processo) se o índice PICKUP existe e está válido."""
+    global _PICKUP_INDEX_OK
+    if _PICKUP_INDEX_OK is None:
+        valido = (await sess.execute(SELECT_PICKUP_INDEX_VALID, {"nome": PICKUP_INDEX})).scalar()
+        _PICKUP_INDEX_OK = bool(valido)
+        if not _PICKUP_INDEX_OK:
+            logger.warning(
+                "⚠️ Índice %s %s: aplicar migrations/001_rota_parada_pickup_unique.sql; "
+                "até lá os PICKUP duplicados são filtrados com SELECT (sem proteção contra escritas concorrentes)",
+                PICKUP_INDEX,
+                "INVALID" if valido is False else "em falta",
+            )
+    return _PICKUP_INDEX_OK
+
+
+async def _insert_pickups(
+    sess: AsyncSession,
+    records: List[Tuple[int, int, int, str]],
+) -> Set[int]:
+    """
+    Insere os PICKUP e devolve os service_id recusados (já com PICKUP noutra rota).
+    Com o índice ux_rota_parada_service_pickup válido: um só INSERT ... SELECT FROM unnest
+    com ON CONFLICT DO NOTHING RETURNING service_id. Sem ele (ou fora do PostgreSQL):
+    SELECT dos PICKUP existentes e insere só os restantes.
+    """
+    if not records:
+        return set()
+
+    conn = await sess.connection()
+    if conn.dialect.name == "postgresql" and await _pickup_index_ok(sess):
+        result = await sess.execute(INSERT_PICKUPS_RETURNING, _unnest_params(records))
+        inseridos = set(result.scalars())
+        return {rec[2] for rec in records} - inseridos
+
+    result = await sess.execute(SELECT_PICKUPS_EXISTENTES, {"service_ids": [rec[2] for rec in records]})
+    existentes = set(result.scalars())
+    await _insert_paradas(sess, [rec for rec in records if rec[2] not in existentes])
+    return existentes
+
+
+async def _insert_paradas(
+    sess: AsyncSession,
+    records: List[Tuple[int, int, int, str]],
+) -> None:
+    """
+    Insere todas as paragens de uma vez, sem ON CONFLICT.
+    Em asyncpg usa COPY (copy_records_to_table) na própria ligação da sessão;
+    noutros drivers PostgreSQL um INSERT ... SELECT FROM unnest(arrays);
+    fora do PostgreSQL cai para um único executemany.
+    """
+    if not records:
+        return
+
+    global _WARNED_NO_COPY
+    conn = await sess.connection()
+    driver = conn.dialect.driver
+    if driver == COPY_DRIVER:
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            "rota_parada", records=records, columns=PARADA_COLUMNS
+        )
+        return
+
+    if not _WARNED_NO_COPY:
+        logger.warning(
+            "⚠️ Driver '%s' sem COPY: paragens via unnest/executemany (use postgresql+%s no engine)",
+            driver,
+            COPY_DRIVER,
+        )
+        _WARNED_NO_COPY = True
+
+    if conn.dialect.name == "postgresql":
+        # um único INSERT ... SELECT FROM unnest: um plano, um statement, 4 parâmetros
+        await sess.execute(INSERT_PARADAS_UNNEST, _unnest_params(records))
+        return
+
+    await sess.execute(INSERT_PARADA, [dict(zip(PARADA_COLUMNS, rec)) for rec in records])
+
+
+async def _reconcile_rotas(
+    sess: AsyncSession,
+    rota_ids: List[int],
+    rota_rows: List[Dict[str, Any]],
+    antes: Set[int],
+    paradas: List[Tuple[Tuple[int, int, int, str], int]],
+) -> List[int]:
+    """
+    Acerta as rotas depois de retirar serviços: apaga as que tinham paragens e ficaram
+    sem nenhuma e recalcula total_ceu das restantes. Devolve os rota_ids que ficam.
+    """
+    ceu_por_rota: Dict[int, int] = {}
+    for (rota_id, _, _, _), ceu in paradas:
+        ceu_por_rota[rota_id] = ceu_por_rota.get(rota_id, 0) + ceu
+
+    vazias = [r for r in rota_ids if r in antes and r not in ceu_por_rota]
+    if vazias:
+        logger.warning("🗑️ Rotas sem serviços após conflitos, removidas: %s", vazias)
+        await sess.execute(DELETE_ROTAS, {"rota_ids": vazias})
+
+    mudadas = [
+        {"b_id": r, "b_total_ceu": ceu_por_rota[r] / 10.0}
+        for r, row in zip(rota_ids, rota_rows)
+        if r in ceu_por_rota and ceu_por_rota[r] / 10.0 != row["total_ceu"]
+    ]
+    if mudadas:
+        await sess.execute(UPDATE_ROTA_CEU, mudadas)
+
+    removidas = set(vazias)
+    return [r for r in rota_ids if r not in removidas]
+
+
+def _node_lookup(
+    routes: List[Tuple[int, List[int]]],
+    df_idx_map: Optional[Dict[int, int]],
+) -> Optional[np.ndarray]:
+    """
+    df_idx_map materializado uma vez como array node → df_idx (identidade fora do mapa).
+    None quando não há mapa (o próprio node é o índice no df).
+    """
+    if not df_idx_map:
+        return None
+    max_node = max((max(path) for _, path in routes if path), default=-1)
+    map_arr = np.arange(max_node + 1, dtype=np.intp)
+    keys = np.fromiter(df_idx_map.keys(), dtype=np.intp, count=len(df_idx_map))
+    vals = np.fromiter(df_idx_map.values(), dtype=np.intp, count=len(df_idx_map))
+    inside = (keys >= 0) & (keys <= max_node)
+    map_arr[keys[inside]] = vals[inside]
+    return map_arr
+
+
+async def _write_routes(
     sess: AsyncSession,
     dia: date,
     df: pd.DataFrame,
     routes: List[Tuple[int, List[int]]],
-    trailer_starts: List[int],
     trailers: List[Dict[str, Any]],
-    df_idx_map: Optional[Dict[int, int]] = None,
-) -> List[int]:
+    df_idx_map: Optional[Dict[int, int]],
+) -> Tuple[List[int], Dict[int, int]]:
     """
-    Persiste rotas e paragens (pickup + delivery).
-    total_km fica a 0, total_ceu = soma de CEU dos pickups.
-    Suporta mapeamento explícito df_idx_map[node] -> df_index.
+    Escreve rotas, paragens e service.rota_id na transação corrente (sem commit).
+    Um serviço só fica numa rota: a 1.ª que o visita neste lote, e nenhuma se já
+    tiver PICKUP noutra rota na BD (nesse caso nem PICKUP, nem entrega, nem backfill).
+    Devolve (rota_ids que ficaram, service_id → rota_id persistido).
     """
-    rota_ids: List[int] = []
+    paradas: List[Tuple[int, int, int, str]] = []
+    ceus: List[int] = []  # CEU de cada paragem (0 nas entregas), alinhado com paradas
+    service_rota: Dict[int, int] = {}
     n_srv = len(df)
+    ceu_arr = df["ceu_int"].to_numpy(dtype=np.int64)
+    id_arr = df["id"].to_numpy(dtype=np.int64)
+
+    # --- cálculo CEU de todas as rotas ---
+    rota_rows: List[Dict[str, Any]] = []
+    path_idx: List[np.ndarray] = []
+
+    map_arr = _node_lookup(routes, df_idx_map)
 
     for vehicle_id, path in routes:
-        trailer = trailers[vehicle_id]
+        nodes = np.asarray(path, dtype=np.intp)
+        idx = map_arr[nodes] if map_arr is not None else nodes
+        path_idx.append(idx)
 
         # --- cálculo CEU ---
-        ceu_total = 0
-        for node in path:
-            if node >= n_srv:
-                continue
-            idx = df_idx_map.get(node, node) if df_idx_map else node
-            if 0 <= idx < len(df):
-                ceu_total += df.ceu_int.iloc[idx]
-            else:
-                logger.warning(f"⚠️ Índice CEU inválido: node={node} → idx={idx}, df_len={len(df)}")
-        ceu = ceu_total / 10.0
-
-        # --- cria a rota ---
-        q_rota = await sess.execute(
-            text(
-                """
-                INSERT INTO rota (data, trailer_id, origem_idx,
-                                  total_km, total_ceu)
-                VALUES (:data, :trailer_id, 0, 0, :total_ceu)
-                RETURNING id
-                """
-            ),
-            {
-                "data": dia,
-                "trailer_id": trailer["id"],
-                "total_ceu": ceu,
-            },
-        )
-        rota_id = q_rota.scalar()
-        if rota_id is None:
-            logger.error("❌ Falha ao criar rota para trailer %s", trailer["registry_trailer"])
-            continue
+        is_pick = nodes < n_srv
+        pick = idx[is_pick]
+        ok = (pick >= 0) & (pick < n_srv)
+        for node, bad in zip(nodes[is_pick][~ok], pick[~ok]):
+            logger.warning(f"⚠️ Índice CEU inválido: node={node} → idx={bad}, df_len={n_srv}")
+        ceu = int(ceu_arr[pick[ok]].sum()) / 10.0
+
+        rota_rows.append({
+            "data": dia,
+            "trailer_id": trailers[vehicle_id]["id"],
+            "origem_idx": 0,
+            "total_km": 0,
+            "total_ceu": ceu,
+        })
+
+    if not rota_rows:
+        return [], {}
 
-        rota_ids.append(rota_id)
+    # --- cria todas as rotas num único INSERT ... RETURNING ---
+    q_rota = await sess.execute(INSERT_ROTA, rota_rows)
+    rota_ids: List[int] = list(q_rota.scalars())
+
+    for rota_id, (vehicle_id, path), rota_row, idx_arr in zip(rota_ids, routes, rota_rows, path_idx):
         logger.info(
             "📝 Rota %s criada para trailer %s (CEU=%.1f)",
             rota_id,
-            trailer["registry_trailer"],
-            ceu,
+            trailers[vehicle_id]["registry_trailer"],
+            rota_row["total_ceu"],
         )
 
-        # --- insere as paragens e atualiza service.rota_id ---
-        for ordem, node in enumerate(path):
-            is_pickup = node < n_srv
-            idx = df_idx_map.get(node, node) if df_idx_map else node
-            if not (0 <= idx < len(df)):
-                logger.warning(f"⚠️ Índice inválido ao buscar service_id: node={node} → idx={idx}, len(df)={len(df)}")
-                continue
-            try:
-                row = df.iloc[idx]
-                service_id = int(row["id"])
-                node_type = "PICKUP" if is_pickup else "DELIVERY"
-
-                await sess.execute(
-                    text(
-                        """
-                        INSERT INTO rota_parada (rota_id, ordem, service_id, node_type)
-                        VALUES (:rota_id, :ordem, :service_id, :node_type)
-                        """
-                    ),
-                    {
-                        "rota_id": rota_id,
-                        "ordem": ordem,
-                        "service_id": service_id,
-                        "node_type": node_type,
-                    },
-                )
-
-                # Atualiza o serviço com rota_id se ainda não tiver
-                await sess.execute(
-                    text(
-                        """
-                        UPDATE ids_monitorados
-                        SET rota_id = :rota_id
-                        WHERE id = :service_id AND rota_id IS NULL
-                        """
-                    ),
-                    {
-                        "rota_id": rota_id,
-                        "service_id": service_id
-                    },
-                )
-
-            except Exception as e:
-                logger.warning(
-                    "⚠️ Erro ao adicionar parada (ordem=%s, node=%s) na rota %s: %s",
-                    ordem,
-                    node,
-                    rota_id,
-                    e,
-                )
-
-    await sess.commit()
-
-    # ✅ Mapear services para rota_id
-    if df_idx_map is None:
-        df_idx_map = {i: i for i in range(len(df))}
-
-    node_to_service = {
-        df_idx_map.get(node, node): rota_id
-        for rota_id, (_, path) in zip(rota_ids, routes)
-        for node in path
-        if node < n_srv and 0 <= df_idx_map.get(node, node) < len(df)
-    }
+        # --- recolhe as paragens e o service.rota_id (1.ª rota de cada serviço) ---
+        # ordem/service_id/node_type da rota inteira em arrays; o ciclo só enumera paragens válidas
+        nodes = np.asarray(path, dtype=np.intp)
+        valid = (idx_arr >= 0) & (idx_arr < n_srv)
+        for node, bad in zip(nodes[~valid].tolist(), idx_arr[~valid].tolist()):
+            logger.warning(f"⚠️ Índice inválido ao buscar service_id: node={node} → idx={bad}, len(df)={n_srv}")
+        ordens = np.flatnonzero(valid).tolist()
+        service_ids = id_arr[idx_arr[valid]].tolist()
+        is_pick = nodes[valid] < n_srv
+        node_types = np.where(is_pick, "PICKUP", "DELIVERY").tolist()
+        ceus.extend(np.where(is_pick, ceu_arr[idx_arr[valid]], 0).tolist())
+        for ordem, service_id, node_type in zip(ordens, service_ids, node_types):
+            paradas.append((rota_id, ordem, service_id, node_type))
+            service_rota.setdefault(service_id, rota_id)
+
+    # --- cada serviço só na 1.ª rota que o visita (a mesma do backfill) ---
+    antes = {p[0] for p in paradas}
+    mantidas = [(p, c) for p, c in zip(paradas, ceus) if service_rota[p[2]] == p[0]]
+
+    # --- PICKUPs primeiro: o RETURNING diz que serviços já estavam noutra rota ---
+    conflitos = await _insert_pickups(sess, [p for p, _ in mantidas if p[3] == "PICKUP"])
+    if conflitos:
+        logger.warning(
+            "⚠️ %d serviço(s) já com PICKUP noutra rota, não persistidos: %s",
+            len(conflitos),
+            sorted(conflitos),
+        )
+        for service_id in conflitos:
+            del service_rota[service_id]
+        mantidas = [(p, c) for p, c in mantidas if p[2] not in conflitos]
+
+    if len(mantidas) < len(paradas):
+        rota_ids = await _reconcile_rotas(sess, rota_ids, rota_rows, antes, mantidas)
+
+    # --- entregas dos serviços aceites num único round-trip ---
+    await _insert_paradas(sess, [p for p, _ in mantidas if p[3] != "PICKUP"])
+
+    # --- atualiza o rota_id dos serviços que ainda não o tenham, num só UPDATE ---
+    if service_rota:
+        await sess.execute(
+            UPDATE_SERVICE_ROTA,
+            {
+                "service_ids": list(service_rota),
+                "rota_ids": list(service_rota.values()),
+            },
+        )
+    return rota_ids, service_rota
+
+
+async def persist_routes(
+    sess: AsyncSession,
+    dia: date,
+    df: pd.DataFrame,
+    routes: List[Tuple[int, List[int]]],
+    trailer_starts: List[int],
+    trailers: List[Dict[str, Any]],
+    df_idx_map: Optional[Dict[int, int]] = None,
+) -> List[int]:
+    """
+    Persiste rotas e paragens (pickup + delivery) numa única transação.
+    total_km fica a 0, total_ceu = soma de CEU dos pickups.
+    Suporta mapeamento explícito df_idx_map[node] -> df_index.
+    df["rota_id"] fica com a rota efetivamente persistida de cada serviço
+    (NaN para os recusados por já terem PICKUP noutra rota).
+    """
+    # uma só transação, sem autoflush do ORM entre statements
+    with sess.no_autoflush:
+        if sess.in_transaction():
+            # a sessão já vem com transação aberta (autobegin das leituras anteriores)
+            rota_ids, service_rota = await _write_routes(sess, dia, df, routes, trailers, df_idx_map)
+            await sess.commit()
+        else:
+            async with sess.begin():
+                rota_ids, service_rota = await _write_routes(sess, dia, df, routes, trailers, df_idx_map)
 
-    # 🧩 Cria nova coluna no df
-    df["rota_id"] = df.index.map(node_to_service.get)
+    # 🧩 rota_id de cada linha = a rota em que o serviço ficou de facto na BD
+    df["rota_id"] = df["id"].map(service_rota)
 
     return rota_ids
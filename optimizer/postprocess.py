@@ -1,4 +1,5 @@
 # backend/solver/optimizer/postprocess.py
+import numpy as np
 import pandas as pd
 import logging
 from datetime import date
@@ -9,6 +10,21 @@ from sqlalchemy import text
 
 logger = logging.getLogger(__name__)
 
+_SQL_TRAILERS_BASE = """
+    SELECT t.id, t.registry_trailer, t.base_city, tc.id as trailer_cat,
+           tc.ceu_max, tc.ligeiro_max, tc.furgo_max, tc.rodado_max
+    FROM trailer t
+    JOIN truck_category tc ON tc.id = t.cat_id
+    WHERE t.ativo = TRUE
+"""
+_SQL_TRAILERS = text(_SQL_TRAILERS_BASE)
+# matrícula comparada no SQL: só o trailer pedido atravessa a rede;
+# :reg chega já com strip()/upper() do Python
+_SQL_TRAILER_BY_REGISTRY = text(
+    _SQL_TRAILERS_BASE
+    + "      AND UPPER(BTRIM(COALESCE(t.registry_trailer, ''), E' \\t\\r\\n')) = :reg\n"
+)
+
 
 async def annotate_solution(
     df: pd.DataFrame,
@@ -17,9 +33,11 @@ async def annotate_solution(
     """
     Marca os serviços que foram alocados a uma rota vs os ignorados.
     """
-    df = df.copy()
-    df["assigned"] = df["id"].isin(assigned_ids)
-    df["status"] = df["assigned"].map(lambda x: "OK" if x else "IGNORED")
+    # Index com hash construído uma vez; status via np.where (sem lambda por linha)
+    # cópia rasa: partilha os dados das colunas existentes, só as novas são alocadas
+    df = df.copy(deep=False)
+    df["assigned"] = df["id"].isin(pd.Index(assigned_ids))
+    df["status"] = np.where(df["assigned"].to_numpy(), "OK", "IGNORED")
     return df
 
 
@@ -41,26 +59,10 @@ async def get_trailers_for_run(
     sess: AsyncSession, df: pd.DataFrame, registry_trailer: Optional[str]
 ) -> List:
     """
-    Carrega trailers e filtra por matrícula se necessário.
+    Carrega trailers e filtra por matrícula se necessário (filtro feito no SQL).
     """
-    q = await sess.execute(
-        text(
-            """
-            SELECT t.id, t.registry_trailer, t.base_city, tc.id as trailer_cat,
-                   tc.ceu_max, tc.ligeiro_max, tc.furgo_max, tc.rodado_max
-            FROM trailer t
-            JOIN truck_category tc ON tc.id = t.cat_id
-            WHERE t.ativo = TRUE
-            """
-        )
-    )
-    trailers = list(q.fetchall())
-
     if registry_trailer:
-        trailers = [
-            t
-            for t in trailers
-            if (t.registry_trailer or "").strip().upper() == registry_trailer.strip().upper()
-        ]
-
-    return trailers
+        q = await sess.execute(_SQL_TRAILER_BY_REGISTRY, {"reg": registry_trailer.strip().upper()})
+    else:
+        q = await sess.execute(_SQL_TRAILERS)
+    return list(q.fetchall())
@@ -4,7 +4,7 @@ from datetime import date
 from typing import Optional, Tuple, List, Dict
 
 import pandas as pd
-from sqlalchemy import text
+from sqlalchemy import Date, bindparam, text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from backend.solver.location_rules import fetch_city_base_map
@@ -16,7 +16,7 @@ from backend.solver.optimizer.utils_df import (
 )
 from backend.solver.optimizer.rules import (
     flag_return_and_base_fields,
-    get_scheduled_base,
+    scheduled_base_series,
 )
 from backend.solver.optimizer.trailer_routing import match_trailers_by_registry_trailer
 
@@ -24,6 +24,46 @@ from backend.solver.utils import norm
 
 logger = logging.getLogger(__name__)
 
+# estado/categoria elegíveis: o mesmo texto é o predicado do índice parcial
+# ix_ids_monitorados_elegiveis (migrations/002_ids_monitorados_eligible_index.sql),
+# para o planner provar que o índice cobre a consulta
+_ELIGIBLE_PREDICATE = """
+        campos->'state'->>'id' IN ('P','PA','A','S','AM')
+      AND campos->'service_category'->>'id' IN (
+            '8','10','12','13','19','25','27','28','29',
+            '33','37','48','50','85','86'
+        )"""
+
+_SQL_ELIGIBLE_SERVICES = text(
+    f"""
+    SELECT
+        id,
+        rota_id,
+        campos->>'registry' AS matricula,
+        campos->'load_city'->>'description'    AS load_city,
+        campos->'unload_city'->>'description'  AS unload_city,
+        campos->>'expected_delivery_date'       AS expected_delivery_date,
+        campos->>'expected_delivery_date_manual'AS expected_delivery_date_manual,
+        campos->'vehicle_category'->>'name'     AS vehicle_category_name
+    FROM ids_monitorados
+    WHERE{_ELIGIBLE_PREDICATE}
+      AND COALESCE(
+            (campos->>'expected_delivery_date_manual')::date,
+            (campos->>'expected_delivery_date')::date
+        ) <= :dia
+    """
+).bindparams(bindparam("dia", type_=Date))
+_ELIGIBLE_COLUMNS = (
+    "id",
+    "rota_id",
+    "matricula",
+    "load_city",
+    "unload_city",
+    "expected_delivery_date",
+    "expected_delivery_date_manual",
+    "vehicle_category_name",
+)
+
 
 async def prepare_input_dataframe(
     sess: AsyncSession,
@@ -48,9 +88,7 @@ async def prepare_input_dataframe(
     base_map = await fetch_city_base_map(sess)
     df = flag_return_and_base_fields(df, base_map)
 
-    df["scheduled_base"] = [
-        get_scheduled_base(row, base_map) for _, row in df.iterrows()
-    ]
+    df["scheduled_base"] = scheduled_base_series(df, base_map)
 
     trailers = await load_trailers(sess)
     trailers = [dict(t._mapping) for t in trailers]
@@ -93,44 +131,19 @@ async def _load_dataframe(
     """
     Executa a query de serviços elegíveis e retorna um DataFrame cru.
     """
-    sql = text(
-        """
-        SELECT
-            id,
-            rota_id,
-            campos->>'registry' AS matricula,
-            campos->'load_city'->>'description'    AS load_city,
-            campos->'unload_city'->>'description'  AS unload_city,
-            campos->>'expected_delivery_date'       AS expected_delivery_date,
-            campos->>'expected_delivery_date_manual'AS expected_delivery_date_manual,
-            campos->'vehicle_category'->>'name'     AS vehicle_category_name
-        FROM ids_monitorados
-        WHERE
-            campos->'state'->>'id' IN ('P','PA','A','S','AM')
-          AND campos->'service_category'->>'id' IN (
-                '8','10','12','13','19','25','27','28','29',
-                '33','37','48','50','85','86'
-            )
-          AND COALESCE(
-                (campos->>'expected_delivery_date_manual')::date,
-                (campos->>'expected_delivery_date')::date
-            ) <= :dia
-        """
-    )
-    result = await sess.execute(sql, {"dia": dia})
-    rows = result.fetchall()
+    result = await sess.execute(_SQL_ELIGIBLE_SERVICES, {"dia": dia})
+    rows = result.mappings().all()
     if not rows:
         logger.warning("⚠️ Nenhum serviço encontrado para %s", dia)
         return None
 
-    df = pd.DataFrame(rows, columns=list(result.keys()))
+    df = pd.DataFrame.from_records(rows, columns=_ELIGIBLE_COLUMNS)
     df["rota_id"] = pd.to_numeric(df["rota_id"], errors="coerce")
-    df["expected_delivery_date"] = pd.to_datetime(df["expected_delivery_date"])
-    df["expected_delivery_date_manual"] = pd.to_datetime(
-        df["expected_delivery_date_manual"], errors="coerce"
-    )
-    df["load_city"] = df["load_city"].astype(str)
-    df["unload_city"] = df["unload_city"].astype(str)
+    # datas ISO vindas do JSON: formato explícito evita a inferência por elemento
+    for col in ("expected_delivery_date", "expected_delivery_date_manual"):
+        df[col] = pd.to_datetime(df[col], format="ISO8601", errors="coerce")
+    # string dtype: cidade em falta fica <NA> (depois "") em vez do texto "None"
+    df[["load_city", "unload_city"]] = df[["load_city", "unload_city"]].astype("string")
     return df
 
 
@@ -139,8 +152,11 @@ def group_similar_services(df: pd.DataFrame) -> pd.DataFrame:
     Agrupa serviços com mesmo load/unload/scheduled_base e soma ceu_int.
     Gera também uma chave service_reg única por linha agrupada.
     """
+    keys = ["load_city", "unload_city", "scheduled_base"]
+    # chaves em category: o groupby agrupa por códigos inteiros em vez de comparar strings
     grouped = (
-        df.groupby(["load_city", "unload_city", "scheduled_base"], dropna=False)
+        df.astype({k: "category" for k in keys})
+        .groupby(keys, dropna=False, observed=True)
         .agg({
             "ceu_int": "sum",
             "id": "first",
@@ -154,6 +170,7 @@ def group_similar_services(df: pd.DataFrame) -> pd.DataFrame:
         })
         .reset_index()
     )
+    grouped[keys] = grouped[keys].astype(object)
     grouped["was_grouped"] = True
     grouped = make_service_reg(grouped)
     return grouped
\ No newline at end of file
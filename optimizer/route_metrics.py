@@ -0,0 +1,63 @@
+# backend/solver/optimizer/route_metrics.py
+import logging
+from itertools import chain
+from typing import Sequence, Tuple
+
+import numpy as np
+
+try:
+    from numba import njit  # type: ignore
+except ImportError:  # pragma: no cover
+    njit = None
+
+logger = logging.getLogger(__name__)
+
+
+def _flatten_paths(paths: Sequence[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Junta todos os paths num só array de nós + offsets (rota r = flat[off[r]:off[r+1]]).
+    """
+    lens = np.fromiter((len(p) for p in paths), dtype=np.intp, count=len(paths))
+    offsets = np.zeros(len(paths) + 1, dtype=np.intp)
+    np.cumsum(lens, out=offsets[1:])
+    flat = np.fromiter(chain.from_iterable(paths), dtype=np.intp, count=int(offsets[-1]))
+    return flat, offsets
+
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _route_km_kernel(flat: np.ndarray, offsets: np.ndarray, dist: np.ndarray) -> np.ndarray:
+        """
+        Kernel numba: soma as arestas consecutivas de cada rota numa só passagem.
+        """
+        n = offsets.shape[0] - 1
+        out = np.zeros(n, dtype=np.int64)
+        for r in range(n):
+            s = 0
+            for k in range(offsets[r] + 1, offsets[r + 1]):
+                s += dist[flat[k - 1], flat[k]]
+            out[r] = s
+        return out
+
+else:
+    _route_km_kernel = None
+
+
+def route_km_totals(dist: np.ndarray, paths: Sequence[Sequence[int]]) -> np.ndarray:
+    """
+    Total de km de cada rota (soma de dist[a, b] entre nós consecutivos do path),
+    calculado para todas as rotas de uma vez.
+    """
+    flat, offsets = _flatten_paths(paths)
+    if _route_km_kernel is not None:
+        return _route_km_kernel(flat, offsets, np.ascontiguousarray(dist, dtype=np.int64))
+
+    # numpy: custo da aresta que chega a cada nó; o 1.º nó de cada rota não tem aresta
+    edge = np.zeros(len(flat) + 1, dtype=np.int64)
+    if len(flat) > 1:
+        edge[2:] = dist[flat[:-1], flat[1:]]
+    starts = offsets[:-1][offsets[:-1] < len(flat)]
+    edge[starts + 1] = 0
+    acc = np.cumsum(edge)
+    return acc[offsets[1:]] - acc[offsets[:-1]]
@@ -1,7 +1,7 @@
 #backend/solver/optimizer/rules.py
 import pandas as pd
 from typing import Optional
-from backend.solver.utils import norm
+from backend.solver.utils import norm, norm_series
 import logging
 
 
@@ -28,9 +28,7 @@ def is_base_location(city: str, base_map: dict[str, str]) -> bool:
         logger.debug("🔎 is_base_location: cidade vazia")
         return False
 
-    city_norm = norm(city)
-    base_cities = set(base_map.keys())  # ← city_norms
-    return city_norm in base_cities
+    return norm(city) in base_map  # chaves = city_norms
 
 
 def get_scheduled_base(row: pd.Series, base_map: dict[str, str]) -> Optional[str]:
@@ -43,6 +41,35 @@ def get_scheduled_base(row: pd.Series, base_map: dict[str, str]) -> Optional[str
         return load
     return _get_base_for_city(str(row.get("unload_city", "")), base_map)
 
+def normalized_city_columns(df: pd.DataFrame) -> tuple[pd.Series, pd.Series]:
+    """
+    load_city/unload_city normalizadas com uma só LUT: norm corre uma vez por
+    cidade distinta das duas colunas (as cidades repetem-se muito entre serviços).
+    """
+    load = df["load_city"].astype(str)
+    unload = df["unload_city"].astype(str)
+    uniq = pd.Series(pd.unique(pd.concat([load, unload], ignore_index=True)), dtype=object)
+    lut = dict(zip(uniq, norm_series(uniq)))
+    # cidade vazia não tem base: "" fica "" em vez de DESCONHECIDA
+    lut.pop("", None)
+    return load.map(lut).fillna(""), unload.map(lut).fillna("")
+
+
+def scheduled_base_series(df: pd.DataFrame, base_map: dict[str, str]) -> pd.Series:
+    """
+    Versão vetorizada de get_scheduled_base para o df inteiro:
+    base da load se existir, senão a da unload, senão None.
+    """
+    load_norm, unload_norm = normalized_city_columns(df)
+    load_base = load_norm.map(base_map)
+    unload_base = unload_norm.map(base_map)
+    # base vazia conta como inexistente (o "if load:" da versão por linha)
+    load_base = load_base.mask(load_base == "")
+    unload_base = unload_base.mask(unload_base == "")
+    base = load_base.combine_first(unload_base).astype(object)
+    return base.where(base.notna(), None)
+
+
 def flag_return_and_base_fields(
     df: pd.DataFrame, base_map: dict[str, str]
 ) -> pd.DataFrame:
@@ -51,26 +78,27 @@ def flag_return_and_base_fields(
       - force_return: unload_city exige retorno a base?
       - load_is_base: load_city é base?
       - unload_is_base: unload_city é base?
+    Devolve um novo DataFrame (cópia rasa): o original não é alterado nem copiado por inteiro.
     """
-    df = df.copy()
-
-    # Log se alguma cidade estiver vazia
-    empty_cities = df[df["load_city"].str.strip() == ""]
-    if not empty_cities.empty:
-        logging.warning("🚨 Entradas com load_city vazia detectadas:")
-        print("\U0001f6a8 Entradas com cidade vazia detectadas:")
-        print(empty_cities[["matricula", "load_city", "unload_city"]])
-
-    # Aplicar marcações de base
-    df["force_return"] = df.apply(lambda r: must_return_to_base(r, base_map), axis=1)
-    df["load_is_base"] = df["load_city"].astype(str).apply(
-        lambda c: is_base_location(c, base_map)
-    )
-    df["unload_is_base"] = df["unload_city"].astype(str).apply(
-        lambda c: is_base_location(c, base_map)
-    )
-
-    # print("\U0001f50e Bases detectadas:")
-    # print(df[["matricula", "load_city", "unload_city", "load_is_base", "unload_is_base"]])
+    # Log se alguma cidade estiver vazia (o detalhe das linhas só é formatado em DEBUG)
+    empty_mask = df["load_city"].astype(str).str.strip() == ""
+    if empty_mask.any():
+        logger.warning("🚨 %d entradas com load_city vazia detectadas", int(empty_mask.sum()))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "🚨 Entradas com cidade vazia:\n%s",
+                df.loc[empty_mask, ["matricula", "load_city", "unload_city"]].to_string(),
+            )
+
+    # Aplicar marcações de base (vetorizado: mesma regra de must_return_to_base / is_base_location)
+    base_keys = frozenset(base_map)
+    load_norm, unload_norm = normalized_city_columns(df)
+    load_in_map = load_norm.isin(base_keys)
+    unload_in_map = unload_norm.isin(base_keys)
+
+    df = df.copy(deep=False)
+    df["force_return"] = unload_in_map
+    df["load_is_base"] = load_in_map
+    df["unload_is_base"] = unload_in_map
 
     return df
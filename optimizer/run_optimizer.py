@@ -1,8 +1,17 @@
 from __future__ import annotations
+import asyncio
+import atexit
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import date
-from typing import Optional, List, Tuple, Union, Set
+from typing import Dict, Optional, List, Tuple, Union, Set
 import faulthandler
+import math
+import os
+from collections import Counter
+import numpy as np
 import pandas as pd
 from sqlalchemy.ext.asyncio import AsyncSession
 from ortools.constraint_solver import pywrapcp
@@ -10,14 +19,22 @@ from itertools import zip_longest, chain
 
 from .prepare_input import prepare_input_dataframe
 from .subset_selection import selecionar_servicos_e_trailers_compativeis
-from .setup_model import setup_routing_model, export_cost_cb_errors_csv
+from .setup_model import setup_routing_model, set_cost_callback, export_cost_cb_errors_csv
 from .constraints import apply_all_constraints
 from .persist_results import persist_routes
-from backend.solver.geocode import fetch_and_store_city
-from backend.solver.utils import norm
+from .route_metrics import route_km_totals
+from backend.solver.geocode import fetch_and_store_cities
+from backend.solver.routing import new_manager_and_model
+from backend.solver.utils import norm, extract_routes
 from backend.solver.optimizer.city_mapping import get_unique_cities
 from backend.solver.optimizer.solve_model import solve_with_params
-from backend.solver.distance import _norm, get_coords, register_coords, exportar_cidades_invalidas_csv
+from backend.solver.distance import (
+    _norm,
+    get_coords,
+    register_coords,
+    exportar_cidades_invalidas_csv,
+    load_pair_cache,
+)
 from backend.solver.optimizer.cluster import agrupar_por_cluster_geografico
 import gc
 import time
@@ -25,14 +42,41 @@ import logging
 
 diagnostico_logger = logging.getLogger("diagnostico_modelo")
 diagnostico_logger.setLevel(logging.ERROR)
-file_handler = logging.FileHandler("diagnostico_modelo.log")
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-diagnostico_logger.addHandler(file_handler)
-
-faulthandler.enable()
+diagnostico_logger.propagate = False
+# idempotente: re-imports (uvicorn --reload, testes) não acumulam FileHandlers
+if not any(
+    isinstance(h, logging.FileHandler) and h.baseFilename.endswith("diagnostico_modelo.log")
+    for h in diagnostico_logger.handlers
+):
+    file_handler = logging.FileHandler("diagnostico_modelo.log")
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    file_handler.setFormatter(formatter)
+    diagnostico_logger.addHandler(file_handler)
+
+# faulthandler só a pedido (ENABLE_FAULTHANDLER=1): não é efeito colateral de cada import
+if os.getenv("ENABLE_FAULTHANDLER") and not faulthandler.is_enabled():
+    faulthandler.enable(all_threads=True)
 logger = logging.getLogger(__name__)
 
+# SOLVER_SOLUTION_LIMIT=N pára a pesquisa após N soluções em vez de gastar todo o time_limit;
+# 0 ou ausente = sem limite
+SOLUTION_LIMIT: Optional[int] = int(os.getenv("SOLVER_SOLUTION_LIMIT", "0")) or None
+
+# pesquisas independentes (1.ª solução, metaheurística) corridas em processos à parte
+# quando SOLVER_WORKERS > 1; o Routing Solver é single-thread por instância
+SOLVER_WORKERS = int(os.getenv("SOLVER_WORKERS", "1"))
+SEARCH_BUDGET_SEC = int(os.getenv("SOLVER_SEARCH_BUDGET_SEC", "120"))
+PARALLEL_SEARCHES: Tuple[Tuple[str, str], ...] = (
+    ("parallel", "guided"),
+    ("savings", "guided"),
+    ("cheapest", "guided"),
+    ("parallel", "tabu"),
+)
+# mais processos do que pesquisas ficariam parados; cada pesquisa recebe o orçamento
+# dividido pelo número de vagas em que as PARALLEL_SEARCHES correm
+SEARCH_POOL_WORKERS = max(1, min(SOLVER_WORKERS, len(PARALLEL_SEARCHES)))
+PARALLEL_SEARCH_SEC = max(1, SEARCH_BUDGET_SEC // math.ceil(len(PARALLEL_SEARCHES) / SEARCH_POOL_WORKERS))
+
 def _get_ceu_capacities(trailers: List[dict]) -> List[int]:
     capacities = []
     for t in trailers:
@@ -55,11 +99,138 @@ async def geocode_all_unique_cities(sess, df: pd.DataFrame):
     cidades.update(_norm(c) for c in df["load_city"].dropna().unique())
     cidades.update(_norm(c) for c in df["unload_city"].dropna().unique())
 
-    for cidade in cidades:
+    try:
+        await fetch_and_store_cities(sess, sorted(cidades))
+    except Exception as e:
+        logger.warning(f"⚠️ Falha ao geocodificar cidades: {e}")
+
+
+_SEARCH_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def _search_pool() -> ProcessPoolExecutor:
+    """
+    Pool de processos das pesquisas paralelas, criado uma vez e reutilizado.
+    spawn: os filhos não herdam threads, event loop nem sockets da BD do processo web.
+    """
+    global _SEARCH_POOL
+    if _SEARCH_POOL is None:
+        _SEARCH_POOL = ProcessPoolExecutor(
+            max_workers=SEARCH_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _SEARCH_POOL
+
+
+def _reset_search_pool() -> None:
+    """Fecha o pool (p.ex. depois de um filho morrer no OR-Tools); o próximo uso cria outro."""
+    global _SEARCH_POOL
+    if _SEARCH_POOL is not None:
+        _SEARCH_POOL.shutdown(wait=False, cancel_futures=True)
+        _SEARCH_POOL = None
+
+
+atexit.register(_reset_search_pool)
+
+
+def _solve_candidate(
+    df_usado: pd.DataFrame,
+    trailers_usados: List[dict],
+    dist_matrix: List[List[int]],
+    starts: List[int],
+    ends: List[int],
+    city_index_map: Dict[str, int],
+    first_solution_strategy: str,
+    local_search_metaheuristic: str,
+    time_limit_sec: int,
+) -> Optional[Tuple[int, List[Tuple[int, List[int]]]]]:
+    """
+    Corre num processo filho: monta o modelo a partir da matriz / starts / ends / mapa
+    já calculados pelo pai (o RoutingModel não é picklable), sem geocoding nem cache de
+    distâncias, resolve com a configuração dada e devolve (objetivo, rotas) ou None.
+    """
+    manager, routing = new_manager_and_model(len(dist_matrix), starts, ends)
+    set_cost_callback(routing, manager, dist_matrix)
+    apply_all_constraints(
+        routing,
+        manager,
+        df_usado,
+        trailers_usados,
+        n_services=len(df_usado),
+        depot_indices=starts,
+        constraint_weights={"ceu": 1.0},
+        city_index_map=city_index_map,
+        enable_pickup_pairs=True,
+    )
+    solution = solve_with_params(
+        routing,
+        manager,
+        time_limit_sec=time_limit_sec,
+        log_search=False,
+        first_solution_strategy=first_solution_strategy,
+        local_search_metaheuristic=local_search_metaheuristic,
+        solution_limit=SOLUTION_LIMIT,
+        lns_time_limit_sec=1,
+    )
+    if solution is None:
+        return None
+    return solution.ObjectiveValue(), extract_routes(routing, manager, solution)
+
+
+async def _solve_parallel(
+    df_usado: pd.DataFrame,
+    trailers_usados: List[dict],
+    dist_matrix: List[List[int]],
+    starts: List[int],
+    ends: List[int],
+    city_index_map: Dict[str, int],
+    time_limit_sec: int,
+) -> Optional[List[Tuple[int, List[int]]]]:
+    """
+    Lança PARALLEL_SEARCHES em SEARCH_POOL_WORKERS processos e devolve as rotas de menor objetivo.
+    Os filhos recebem só dados picklable já preparados pelo pai.
+    """
+    loop = asyncio.get_running_loop()
+    # um filho que morre (segfault no OR-Tools) parte o pool inteiro: recria-se e tenta-se outra vez
+    for tentativa in (1, 2):
         try:
-            await fetch_and_store_city(sess, cidade)
-        except Exception as e:
-            logger.warning(f"⚠️ Falha ao geocodificar {cidade}: {e}")
+            pool = _search_pool()
+            futures = [
+                loop.run_in_executor(
+                    pool,
+                    _solve_candidate,
+                    df_usado,
+                    trailers_usados,
+                    dist_matrix,
+                    starts,
+                    ends,
+                    city_index_map,
+                    fs,
+                    mh,
+                    time_limit_sec,
+                )
+                for fs, mh in PARALLEL_SEARCHES
+            ]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+        except BrokenProcessPool as e:
+            results = [e] * len(PARALLEL_SEARCHES)
+        if not any(isinstance(r, BrokenProcessPool) for r in results):
+            break
+        logger.warning(f"⚠️ Pool de pesquisas partido (tentativa {tentativa}); a recriar")
+        _reset_search_pool()
+
+    best: Optional[Tuple[int, List[Tuple[int, List[int]]]]] = None
+    for (fs, mh), res in zip(PARALLEL_SEARCHES, results):
+        if isinstance(res, BaseException):
+            logger.warning(f"⚠️ Pesquisa {fs}/{mh} falhou: {res}")
+            continue
+        if res is None:
+            logger.info(f"🔕 Pesquisa {fs}/{mh} sem solução")
+            continue
+        logger.info(f"🏁 Pesquisa {fs}/{mh} → objetivo {res[0]}")
+        if best is None or res[0] < best[0]:
+            best = res
+    return best[1] if best is not None else None
 
 
 async def optimize(
@@ -69,9 +240,14 @@ async def optimize(
     categoria_filtrada: Optional[List[str]] = None,
     debug: bool = False,
     safe: bool = False,
-    max_voltas: int = 10
+    max_voltas: int = 10,
+    *,
+    prepared: Optional[Tuple[pd.DataFrame, List[dict], Dict[str, str]]] = None,
 ) -> Union[List[int], Tuple[List[int], pd.DataFrame]]:
-    df, trailers, base_map = await prepare_input_dataframe(sess, dia, registry_trailer)
+    # prepared=(df, trailers, base_map) já obtido pelo chamador: evita repetir query + preparação
+    if prepared is None:
+        prepared = await prepare_input_dataframe(sess, dia, registry_trailer)
+    df, trailers, base_map = prepared
 
     if "service_reg" not in df.columns:
         raise ValueError("❌ Faltando coluna obrigatória: service_reg")
@@ -88,6 +264,7 @@ async def optimize(
         if coords is not None:
             coords_map[base] = coords
     register_coords(coords_map)
+    load_pair_cache()
 
     rota_ids_total = []
     trailers_restantes = trailers
@@ -127,6 +304,11 @@ async def optimize(
             if not df_restante.empty:
                 logger.debug(f"🕗 Não alocados mas ainda considerados: {df_restante['service_reg'].tolist()}")
 
+        # nada coube em nenhum trailer: não vale a pena montar o modelo OR-Tools
+        if df_usado.empty or not trailers_usados:
+            logger.info(f"🔕 Rodada {rodada}: nenhum serviço alocável, modelo não construído")
+            continue
+
         # ✅ Validação das colunas obrigatórias antes de setup_routing_model
         required_cols = ["id", "service_reg", "ceu_int", "load_city", "unload_city", "scheduled_base"]
         missing_cols = [col for col in required_cols if col not in df_usado.columns]
@@ -156,8 +338,12 @@ async def optimize(
         if not df_usado.empty:
             logger.debug(f"🔍 Primeira linha: {df_usado.iloc[0].to_dict()}")
 
+        paralelo = SOLVER_WORKERS > 1
         try:
-            routing, manager, starts, dist_matrix, df_idx_map = setup_routing_model(df_usado, trailers_usados, debug=debug)
+            # em paralelo o pai não monta o RoutingModel: só matriz, starts e mapas
+            routing, manager, starts, dist_matrix, df_idx_map, city_index_map = setup_routing_model(
+                df_usado, trailers_usados, debug=debug, with_model=not paralelo
+            )
         except Exception as e:
             logger.error(f"❌ Erro ao preparar modelo de rota: {e}")
             diagnostico_logger.error(
@@ -169,69 +355,76 @@ async def optimize(
             )
             continue
 
-        apply_all_constraints(
-            routing,
-            manager,
-            df_usado,
-            trailers_usados,
-            n_services=len(df_usado),
-            depot_indices=starts,
-            distance_matrix=dist_matrix,
-            constraint_weights={"ceu": 1.0},
-            enable_pickup_pairs=True,
-        )
-
-        strategy = "tabu" if len(trailers_usados) > 3 else "guided"
-        solution = solve_with_params(
-            routing,
-            manager,
-            time_limit_sec=120,
-            log_search=True,
-            first_solution_strategy="cheapest",
-            local_search_metaheuristic=strategy,
-        )
+        routes: Optional[List[Tuple[int, List[int]]]] = None
+        if paralelo:
+            ends = [manager.IndexToNode(manager.GetEndIndex(v)) for v in range(len(starts))]
+            routes = await _solve_parallel(
+                df_usado,
+                trailers_usados,
+                dist_matrix,
+                starts,
+                ends,
+                city_index_map,
+                PARALLEL_SEARCH_SEC,
+            )
+        else:
+            apply_all_constraints(
+                routing,
+                manager,
+                df_usado,
+                trailers_usados,
+                n_services=len(df_usado),
+                depot_indices=starts,
+                constraint_weights={"ceu": 1.0},
+                city_index_map=city_index_map,
+                enable_pickup_pairs=True,
+            )
 
-        if solution is None:
-            logger.warning(f"❌ Nenhuma solução encontrada na rodada {rodada} com 'cheapest'. Tentando fallback com 'savings'.")
+            strategy = "tabu" if len(trailers_usados) > 3 else "guided"
             solution = solve_with_params(
                 routing,
                 manager,
-                time_limit_sec=60,
+                time_limit_sec=SEARCH_BUDGET_SEC,
                 log_search=True,
-                first_solution_strategy="savings",
+                first_solution_strategy="parallel",
                 local_search_metaheuristic=strategy,
+                solution_limit=SOLUTION_LIMIT,
+                lns_time_limit_sec=1,
             )
 
-        if solution is None:
+            if solution is None:
+                logger.warning(f"❌ Nenhuma solução encontrada na rodada {rodada} com 'parallel'. Tentando fallback com 'savings'.")
+                solution = solve_with_params(
+                    routing,
+                    manager,
+                    time_limit_sec=60,
+                    log_search=True,
+                    first_solution_strategy="savings",
+                    local_search_metaheuristic=strategy,
+                    solution_limit=SOLUTION_LIMIT,
+                    lns_time_limit_sec=1,
+                )
+            if solution is not None:
+                routes = extract_routes(routing, manager, solution)
+
+        if routes is None:
             logger.warning(f"❌ Nenhuma solução encontrada na rodada {rodada} após fallback.")
             continue
 
-        unique_cities = get_unique_cities(df_usado, trailers_usados)
-        routes: List[Tuple[int, List[int]]] = []
-        for v in range(len(trailers_usados)):
-            idx = routing.Start(v)
-            path = []
-            total_km = 0
-            while not routing.IsEnd(idx):
-                node = manager.IndexToNode(idx)
-                path.append(node)
-                logger.debug(f"🚏 Veículo {v} → nó {node} = {unique_cities[node]}")
-                next_idx = solution.Value(routing.NextVar(idx))
-                if not routing.IsEnd(next_idx):
-                    from_node = manager.IndexToNode(idx)
-                    to_node = manager.IndexToNode(next_idx)
-                    total_km += dist_matrix[from_node][to_node]
-                idx = next_idx
-            if path:
-                logger.info(f"🛳️ Veículo {v} → rota = {path} → Total km: {total_km:.2f}")
-                if debug:
-                    agrupamento = {}
-                    for node in path:
-                        cidade = unique_cities[node]
-                        agrupamento[cidade] = agrupamento.get(cidade, 0) + 1
-                    agrupado_str = ", ".join(f"{c}: {n}" for c, n in agrupamento.items())
-                    logger.debug(f"🩹 Veículo {v} → agrupamento por cidade: {agrupado_str}")
-                routes.append((v, path))
+        # nó do modelo → cidade normalizada, indexável com o path inteiro
+        city_of_node = np.asarray(get_unique_cities(df_usado, trailers_usados), dtype=object)
+        dist_np = np.asarray(dist_matrix, dtype=np.int64)
+
+        # km de todas as rotas numa só passagem (kernel numba quando disponível)
+        km_totals = route_km_totals(dist_np, [path for _, path in routes]).tolist()
+        for (v, path), total_km in zip(routes, km_totals):
+            logger.info(f"🛳️ Veículo {v} → rota = {path} → Total km: {total_km:.2f}")
+            if debug:
+                cidades = city_of_node[np.asarray(path, dtype=np.intp)].tolist()
+                logger.debug(f"🚏 Veículo {v} → cidades = {cidades}")
+                agrupamento = Counter(cidades)
+                agrupado_str = ", ".join(f"{c}: {n}" for c, n in agrupamento.items())
+                logger.debug(f"🩹 Veículo {v} → agrupamento por cidade: {agrupado_str}")
 
         rota_ids = await persist_routes(sess, dia, df_usado, routes, trailer_starts=starts, trailers=trailers_usados, df_idx_map=df_idx_map)
         rota_ids_total.extend(rota_ids)
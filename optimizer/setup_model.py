@@ -1,7 +1,7 @@
 # backend/solver/optimizer/setup_model.py
 
 import logging
-from typing import List, Tuple, Dict
+from typing import Dict, List, Optional, Tuple
 from ortools.constraint_solver import pywrapcp
 import pandas as pd
 import os
@@ -11,6 +11,8 @@ from backend.solver.optimizer.city_mapping import (
     build_city_index_and_matrix,
     map_bases_to_indices,
 )
+from backend.solver.routing import new_manager, new_manager_and_model, register_distance_transit
+from backend.solver.utils import node_index_array
 
 logger = logging.getLogger(__name__)
 
@@ -50,9 +52,7 @@ def create_manager_and_model(
     logger.debug(f"🧭 Locais: {n_nodes}, Veículos: {n_vehicles}")
     logger.debug(f"🔁 Starts: {starts}, 🔚 Ends: {ends}")
 
-    manager = pywrapcp.RoutingIndexManager(n_nodes, n_vehicles, starts, ends)
-    routing = pywrapcp.RoutingModel(manager)
-    return manager, routing
+    return new_manager_and_model(n_nodes, starts, ends)
 
 
 def set_cost_callback(
@@ -60,54 +60,20 @@ def set_cost_callback(
     manager: pywrapcp.RoutingIndexManager,
     dist_matrix: List[List[int]],
 ):
-    DEFAULT_PENALTY = 999_999
-
-    def cost_cb(i: int, j: int) -> int:
-        from_node, to_node = -1, -1
-        try:
-            if not (0 <= i < routing.Size()) or not (0 <= j < routing.Size()):
-                _COST_CB_ERRORS.append({"i": i, "j": j, "erro": "index fora de range do routing.Size()"})
-                return DEFAULT_PENALTY
-
-            try:
-                from_node = manager.IndexToNode(i)
-                to_node = manager.IndexToNode(j)
-            except Exception as e:
-                _COST_CB_ERRORS.append({"i": i, "j": j, "erro": f"IndexToNode falhou: {e}"})
-                return DEFAULT_PENALTY
-
-            if not (0 <= from_node < len(dist_matrix)):
-                _COST_CB_ERRORS.append({"from_node": from_node, "to_node": to_node, "erro": "from_node fora do dist_matrix"})
-                return DEFAULT_PENALTY
-
-            if not (0 <= to_node < len(dist_matrix[from_node])):
-                _COST_CB_ERRORS.append({"from_node": from_node, "to_node": to_node, "erro": "to_node fora da linha"})
-                return DEFAULT_PENALTY
-
-            custo = dist_matrix[from_node][to_node]
-
-            if not isinstance(custo, int):
-                _COST_CB_ERRORS.append({
-                    "from_node": from_node,
-                    "to_node": to_node,
-                    "erro": "custo não int",
-                    "valor": custo
-                })
-                return DEFAULT_PENALTY
-
-            return custo
-
-        except Exception as e:
-            _COST_CB_ERRORS.append({
-                "i": i, "j": j,
-                "from_node": from_node, "to_node": to_node,
-                "erro": f"exceção inesperada: {e}"
-            })
-            return DEFAULT_PENALTY
-
-    index = routing.RegisterTransitCallback(cost_cb)
+    """
+    Custo-arco = km entre as cidades dos nós, incluindo o arco final até ao End do
+    veículo (regresso à base). Antes o callback tratava os índices End (>= Size())
+    como fora de range e cobrava DEFAULT_PENALTY fixo; o regresso conta agora em km,
+    de propósito, tanto na matriz nativa como no callback de fallback.
+    """
+    def cost_miss(i: int, j: int) -> int:
+        # arco fora do manager / da matriz: fica para export_cost_cb_errors_csv
+        _COST_CB_ERRORS.append({"i": i, "j": j, "erro": "arco fora do manager ou do dist_matrix"})
+        return DEFAULT_PENALTY
+
+    index = register_distance_transit(routing, manager, dist_matrix, on_miss=cost_miss)
     routing.SetArcCostEvaluatorOfAllVehicles(index)
-    logger.debug("✅ Callback de custo registrado com proteção")
+    logger.debug("✅ Custo-arco registrado")
 
 
 
@@ -124,13 +90,16 @@ def export_cost_cb_errors_csv():
 def setup_routing_model(
     df: pd.DataFrame,
     trailers: List[dict],
-    debug=False
+    debug=False,
+    *,
+    with_model: bool = True,
 ) -> Tuple[
-    pywrapcp.RoutingModel,
+    Optional[pywrapcp.RoutingModel],
     pywrapcp.RoutingIndexManager,
     List[int],
     List[List[int]],
-    Dict[int, int]
+    Dict[int, int],
+    Dict[str, int]
 ]:
     """
     Setup do modelo de roteamento com OR-Tools.
@@ -139,11 +108,14 @@ def setup_routing_model(
         df (pd.DataFrame): DataFrame contendo as entregas.
         trailers (List[dict]): Lista de dicionários com informações dos trailers.
         debug (bool): Flag para logs detalhados.
+        with_model (bool): False → só manager + matriz + mapas (routing = None), para
+            quem resolve noutro processo e só precisa de starts / matriz / df_idx_map.
 
     Returns:
-        Tuple: routing, manager, starts, padded_matrix, df_idx_map
+        Tuple: routing, manager, starts, padded_matrix, df_idx_map, city_index_map
+        (city_index_map é a ordem de nós do modelo: as restrições têm de usar este mesmo mapa)
     """
-    print("\U0001F525 setup_routing_model foi chamado")
+    logger.debug("\U0001F525 setup_routing_model foi chamado")
 
     locations, city_index_map, dist_matrix = build_city_index_and_matrix(df, trailers)
 
@@ -183,7 +155,10 @@ def setup_routing_model(
     if not locations:
         raise ValueError("Lista de 'locations' está vazia — verifique entradas do DataFrame.")
 
-    manager, routing = create_manager_and_model(locations, starts, ends)
+    if with_model:
+        manager, routing = create_manager_and_model(locations, starts, ends)
+    else:
+        manager, routing = new_manager(len(locations), starts, ends), None
 
     padded_matrix = pad_dist_matrix(dist_matrix, manager.GetNumberOfNodes())
 
@@ -199,20 +174,18 @@ def setup_routing_model(
         preview_rows = padded_matrix[:min(5, len(padded_matrix))]
         logger.debug(f"🔍 Preview padded_matrix (máx 5 linhas): {preview_rows}")
 
-    set_cost_callback(routing, manager, padded_matrix)
-    logger.info("✅ Callback de custo de distância definido")
+    if routing is not None:
+        set_cost_callback(routing, manager, padded_matrix)
+        logger.info("✅ Callback de custo de distância definido")
 
     df = df.reset_index(drop=True)
-    df_idx_map = {}
-    max_valid_node = len(df) - 1
-    for node in range(manager.GetNumberOfNodes()):
-        if node > max_valid_node:
-            continue
-        try:
-            solver_idx = manager.NodeToIndex(node)
-            df_idx_map[solver_idx] = node
-        except Exception as e:
-            logger.error(f"❌ Erro ao mapear node={node} → solver_idx: {e}")
+    # NodeToIndex de todos os nós numa só passagem (cache no manager)
+    try:
+        node_to_idx = node_index_array(manager)
+    except Exception as e:
+        logger.error(f"❌ Erro ao mapear nodes → solver_idx: {e}")
+        node_to_idx = []
+    df_idx_map = {solver_idx: node for node, solver_idx in enumerate(node_to_idx[: len(df)])}
 
     if debug:
         for solver_idx, df_idx in df_idx_map.items():
@@ -223,9 +196,9 @@ def setup_routing_model(
             logger.debug(f"🔗 Solver node {solver_idx} → df_idx {df_idx} → ID={row['id']}, matrícula={row.get('matricula')}, cidade={row.get('load_city')}")
 
 
-    if routing.vehicles() == 0 or manager.GetNumberOfNodes() == 0:
+    if manager.GetNumberOfVehicles() == 0 or manager.GetNumberOfNodes() == 0:
         raise ValueError("❌ Modelo inválido: sem veículos ou nós.")
     
     
 
-    return routing, manager, starts, padded_matrix, df_idx_map
+    return routing, manager, starts, padded_matrix, df_idx_map, city_index_map
@@ -13,9 +13,14 @@ def solve_with_params(
     log_search: bool = True,
     first_solution_strategy: str = "cheapest",
     local_search_metaheuristic: str = "guided",
+    solution_limit: int | None = None,
+    lns_time_limit_sec: int | None = None,
 ) -> pywrapcp.Assignment | None:
     """
     Resolve o modelo com parâmetros configurados.
+    solution_limit pára a pesquisa após N soluções (pode terminar antes do time_limit).
+    lns_time_limit_sec só limita cada sub-pesquisa LNS, não a pesquisa global:
+    o orçamento total continua a ser time_limit_sec.
     """
 
     strategy_map = {
@@ -41,6 +46,13 @@ def solve_with_params(
     search_params.local_search_metaheuristic = metaheuristic_map.get(
         local_search_metaheuristic.lower(), routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
     )
+    if solution_limit is not None:
+        search_params.solution_limit = solution_limit
+    if lns_time_limit_sec is not None:
+        search_params.lns_time_limit.seconds = lns_time_limit_sec
+    # pesquisa local sem propagação CP completa entre movimentos (campo ausente em versões novas)
+    if "use_full_propagation" in search_params.DESCRIPTOR.fields_by_name:
+        search_params.use_full_propagation = False
 
     logger.debug(f"🔍 Validando modelo: {routing.vehicles()} veículos, {routing.Size()} nós")
 
@@ -99,6 +111,11 @@ def extract_solution(
 
     rotas_extraidas = []
     linhas_csv = []
+    n_df = len(df)
+
+    # colunas resolvidas uma vez: acesso escalar ao array em vez de df.iloc[...] por nó
+    campos = {"id": "id", "matricula": "matricula", "cidade": "load_city", "service_reg": "service_reg"}
+    colunas = {k: (df[c].to_numpy() if c in df.columns else None) for k, c in campos.items()}
 
     try:
         for veiculo_id in range(routing.vehicles()):
@@ -113,17 +130,10 @@ def extract_solution(
                 solver_idx = index
                 df_idx = df_idx_map.get(solver_idx, None)
 
-                if df_idx is not None and 0 <= df_idx < len(df):
-                    row = df.iloc[df_idx]
-                    linha = {
-                        "veiculo_id": veiculo_id,
-                        "ordem": ordem,
-                        "node_id": node_id,
-                        "id": row.get("id"),
-                        "matricula": row.get("matricula"),
-                        "cidade": row.get("load_city"),
-                        "service_reg": row.get("service_reg"),
-                    }
+                if df_idx is not None and 0 <= df_idx < n_df:
+                    linha = {"veiculo_id": veiculo_id, "ordem": ordem, "node_id": node_id}
+                    for k, arr in colunas.items():
+                        linha[k] = arr[df_idx] if arr is not None else None
                     linhas_csv.append(linha)
 
                 ordem += 1
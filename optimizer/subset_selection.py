@@ -24,7 +24,7 @@ def selecionar_servicos_e_trailers_compativeis(
             "restante": cap,
             "base_city": t.get("base_city", "")
         })
-        logger.warning("\U0001f69b Trailer %d: ceu_max=%s → cap_int=%d", i, t.get("ceu_max"), cap)
+        logger.debug("\U0001f69b Trailer %d: ceu_max=%s → cap_int=%d", i, t.get("ceu_max"), cap)
 
     group_cols = ["id", "registry"] if "registry" in df.columns else ["id"]
     grouped = df.groupby(group_cols)
@@ -58,10 +58,11 @@ def selecionar_servicos_e_trailers_compativeis(
 
         for block in blocos_base:
             for trailer in trailers_base:
-                usado = trailer["cap"] - trailer["restante"]
-                ocupacao = (usado / trailer["cap"] * 100) if trailer["cap"] > 0 else 0
-                status = "\U0001f7e2 usado" if trailer["idx"] in used_trailer_idxs else "⚪ não usado"
-                logger.info(f"\U0001f9ae Trailer {trailer['idx']}: ocupação = {usado}/{trailer['cap']} CEU ({ocupacao:.1f}%) {status}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    usado = trailer["cap"] - trailer["restante"]
+                    ocupacao = (usado / trailer["cap"] * 100) if trailer["cap"] > 0 else 0
+                    status = "\U0001f7e2 usado" if trailer["idx"] in used_trailer_idxs else "⚪ não usado"
+                    logger.debug(f"\U0001f9ae Trailer {trailer['idx']}: ocupação = {usado}/{trailer['cap']} CEU ({ocupacao:.1f}%) {status}")
                 if block["ceu"] <= trailer["restante"]:
                     trailer["restante"] -= block["ceu"]
                     used_services.append(block["df"])
@@ -71,7 +72,7 @@ def selecionar_servicos_e_trailers_compativeis(
                         "services": []
                     })
                     alocacoes_por_trailer[trailer["idx"]]["services"].append(block["service_reg"])
-                    logger.warning("✅ Alocado %s no trailer %d", block["service_reg"], trailer["idx"])
+                    logger.debug("✅ Alocado %s no trailer %d", block["service_reg"], trailer["idx"])
                     break
             else:
                 logger.warning("❌ %s não coube em nenhum trailer na base %s", block["service_reg"], base)
@@ -111,7 +112,7 @@ def selecionar_servicos_e_trailers_compativeis(
                         "services": []
                     })
                     alocacoes_por_trailer[trailer["idx"]]["services"].append(block["service_reg"])
-                    logger.warning("✅ [fallback] Alocado %s no trailer %d (%.1f km)", block["service_reg"], trailer["idx"], dist)
+                    logger.debug("✅ [fallback] Alocado %s no trailer %d (%.1f km)", block["service_reg"], trailer["idx"], dist)
                     break
             else:
                 logger.warning("❌ [fallback] %s não coube em nenhum trailer disponível", block["service_reg"])
@@ -3,7 +3,7 @@ from typing import Any, Callable
 import pandas as pd
 import logging
 
-from backend.solver.utils import norm
+from backend.solver.utils import norm_series
 
 
 def filter_services_by_category(
@@ -18,12 +18,9 @@ def filter_services_by_category(
     """
     df = df.copy()
 
-    def load_is_base(row) -> bool:
-        load_city = str(row.get("load_city", "")).upper()
-        expected_base = base_map.get(norm(load_city))
-        return expected_base == norm(load_city)
-
-    df["load_is_base"] = df.apply(load_is_base, axis=1)
+    # base esperada == própria cidade normalizada (pipeline .str, sem apply por linha)
+    load_norm = norm_series(df["load_city"].astype(str))
+    df["load_is_base"] = load_norm.map(base_map) == load_norm
 
     # Filtra apenas os serviços que NÃO violam a regra
     mask = ~(
@@ -1,12 +1,13 @@
 # backend\solver\optimizer\utils_df.py
 import pandas as pd
-from backend.solver.utils import norm
+from backend.solver.utils import norm_series
 
 
 def normalize_city_fields(df: pd.DataFrame) -> pd.DataFrame:
     df = df.copy()
-    df["load_city"] = df["load_city"].apply(lambda x: norm(x) if pd.notnull(x) else "")
-    df["unload_city"] = df["unload_city"].apply(lambda x: norm(x) if pd.notnull(x) else "")
+    # normaliza uma vez por cidade distinta; o resto do pipeline já recebe nomes normalizados
+    for col in ("load_city", "unload_city"):
+        df[col] = norm_series(df[col]).where(df[col].notna(), "")
     return df
 
 
@@ -27,14 +28,14 @@ def calculate_ceu(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def add_base_flags(df: pd.DataFrame, base_map: dict) -> pd.DataFrame:
-    def is_base(row, col):
-        city = str(row.get(col, "")).upper()
-        expected = base_map.get(norm(city))
-        return expected == norm(city)
-
-    df["load_is_base"] = df.apply(lambda r: is_base(r, "load_city"), axis=1)
-    df["unload_is_base"] = df.apply(lambda r: is_base(r, "unload_city"), axis=1)
-    df["force_return"] = df["unload_city"].map(lambda c: norm(c) in base_map)
+    # pipeline .str de norm_series (uma vez por cidade distinta) em vez de norm() por linha
+    def is_base(col: str) -> pd.Series:
+        city_norm = norm_series(df[col].astype(str))
+        return city_norm.map(base_map) == city_norm
+
+    df["load_is_base"] = is_base("load_city")
+    df["unload_is_base"] = is_base("unload_city")
+    df["force_return"] = norm_series(df["unload_city"]).isin(list(base_map))
 
     return df
 
@@ -28,6 +28,11 @@ async def persist_routes(
         return []
 
     total_services = len(df)
+    # invariantes do ciclo: ids/cidades em arrays, bases num set
+    start_nodes = set(trailer_starts)
+    id_arr = df["id"].to_numpy()
+    orig_load = df["orig_load_city"].to_numpy() if "orig_load_city" in df else None
+    orig_unload = df["orig_unload_city"].to_numpy() if "orig_unload_city" in df else None
 
     for vehicle_id, path in routes:
         if len(path) <= 1:
@@ -44,7 +49,7 @@ async def persist_routes(
         sess.add(rota)
 
         for ordem, node in enumerate(path):
-            if node in trailer_starts:
+            if node in start_nodes:
                 logging.debug(f"↩️ Ignorado node de base (index {node}).")
                 continue  # ignora base
 
@@ -63,17 +68,13 @@ async def persist_routes(
                 parada = RotaParada(
                     rota=rota,
                     ordem=ordem,
-                    service_id=int(df.id.iat[srv_idx]),
+                    service_id=int(id_arr[srv_idx]),
                     node_type=node_type,
                     orig_load_city=(
-                        str(df.orig_load_city.iat[srv_idx])
-                        if "orig_load_city" in df
-                        else None
+                        str(orig_load[srv_idx]) if orig_load is not None else None
                     ),
                     orig_unload_city=(
-                        str(df.orig_unload_city.iat[srv_idx])
-                        if "orig_unload_city" in df
-                        else None
+                        str(orig_unload[srv_idx]) if orig_unload is not None else None
                     ),
                 )
                 sess.add(parada)
@@ -3,6 +3,7 @@ from __future__ import annotations
 
 from typing import List, Dict, Callable, Optional, Tuple
 from ortools.constraint_solver import pywrapcp
+import numpy as np
 import pandas as pd
 import logging
 
@@ -11,6 +12,18 @@ logger = logging.getLogger(__name__)
 # ―――­­­­­­­­­­­­­­­­­­­­ CONSTANTES ――― #
 DEFAULT_PENALTY = 99_999  # custo p / arco quando dá erro
 BIG_M = 10_000_000  # upper-bound “folgado” para dimensão DIST
+MAX_CALLBACK_CACHE = 1_000_000  # teto p/ cache de callbacks (n_nodes² entradas)
+
+
+def routing_model_parameters(n_nodes: int) -> pywrapcp.RoutingModelParameters:
+    """
+    Parâmetros do RoutingModel: cache de callbacks até n_nodes² (com teto) e
+    redução do modelo de custo — todos os veículos partilham o mesmo avaliador.
+    """
+    params = pywrapcp.DefaultRoutingModelParameters()
+    params.max_callback_cache_size = min(n_nodes * n_nodes, MAX_CALLBACK_CACHE)
+    params.reduce_vehicle_cost_model = True
+    return params
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -42,9 +55,70 @@ def safe_dist_lookup(
         return DEFAULT_PENALTY
 
 
+def register_distance_transit(
+    routing: pywrapcp.RoutingModel,
+    manager: pywrapcp.RoutingIndexManager,
+    dist_matrix: List[List[int]],
+    on_miss: Optional[Callable[[int, int], int]] = None,
+) -> int:
+    """
+    Regista a matriz de distâncias como transit callback.
+    Usa RegisterTransitMatrix (avaliado em C++, sem passar pelo Python por arco)
+    quando a matriz cobre todos os nós; senão cai no callback seguro.
+    on_miss(i, j) dá o custo dos arcos fora da matriz (por omissão safe_dist_lookup).
+    """
+    n_nodes = manager.GetNumberOfNodes()
+    if (
+        hasattr(routing, "RegisterTransitMatrix")
+        and len(dist_matrix) == n_nodes
+        and all(len(row) == n_nodes for row in dist_matrix)
+    ):
+        return routing.RegisterTransitMatrix([[int(d) for d in row] for row in dist_matrix])
+
+    # fallback python: IndexToNode pré-calculado, sem chamadas C++ por arco
+    n_idx = manager.GetNumberOfIndices()
+    node_of = [manager.IndexToNode(i) for i in range(n_idx)]
+    n = len(dist_matrix)
+    if on_miss is None:
+        on_miss = lambda i, j: safe_dist_lookup(dist_matrix, manager, i, j)
+
+    def dist_cb(i: int, j: int) -> int:
+        if 0 <= i < n_idx and 0 <= j < n_idx:
+            a, b = node_of[i], node_of[j]
+            if a < n and b < len(dist_matrix[a]):
+                return dist_matrix[a][b]
+        return on_miss(i, j)
+
+    return routing.RegisterTransitCallback(dist_cb)
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # 2.  MANAGER + MODEL + COST
 # ══════════════════════════════════════════════════════════════════════════════
+def new_manager(
+    n_nodes: int,
+    starts: List[int],
+    ends: List[int],
+) -> pywrapcp.RoutingIndexManager:
+    """
+    Só o RoutingIndexManager (barato): chega para mapear nós ↔ índices sem montar o modelo.
+    """
+    return pywrapcp.RoutingIndexManager(n_nodes, len(starts), starts, ends)
+
+
+def new_manager_and_model(
+    n_nodes: int,
+    starts: List[int],
+    ends: List[int],
+) -> tuple[pywrapcp.RoutingIndexManager, pywrapcp.RoutingModel]:
+    """
+    Único ponto de construção do RoutingIndexManager + RoutingModel (um veículo por start).
+    """
+    manager = new_manager(n_nodes, starts, ends)
+    routing = pywrapcp.RoutingModel(manager, routing_model_parameters(n_nodes))
+    return manager, routing
+
+
 def build_routing_model(
     n_nodes: int,
     n_vehicles: int,
@@ -55,13 +129,12 @@ def build_routing_model(
     """
     Cria RoutingIndexManager + RoutingModel já com o custo-arco = distância.
     """
-    manager = pywrapcp.RoutingIndexManager(n_nodes, n_vehicles, starts, ends)
-    routing = pywrapcp.RoutingModel(manager)
+    if n_vehicles != len(starts):
+        raise ValueError(f"🚨 n_vehicles ≠ len(starts): {n_vehicles} ≠ {len(starts)}")
+    manager, routing = new_manager_and_model(n_nodes, starts, ends)
 
     # ­callback de distância
-    cb_idx = routing.RegisterTransitCallback(
-        lambda i, j: safe_dist_lookup(dist_matrix, manager, i, j)
-    )
+    cb_idx = register_distance_transit(routing, manager, dist_matrix)
     routing.SetArcCostEvaluatorOfAllVehicles(cb_idx)
     return manager, routing
 
@@ -85,8 +158,20 @@ def create_demand_callbacks(
     cb_indices: Dict[str, int] = {}
     demand_fns: Dict[str, Callable[[int], int]] = {}
     n = len(df)
+    depots = set(depot_indices)
+
+    # Demandas de pickup pré-calculadas por tipo (delivery = 0)
+    cats = df["vehicle_category_name"].fillna("").astype(str).str.lower()
+    pickup_demand: Dict[str, List[int]] = {
+        "ceu": pd.to_numeric(df["ceu_int"], errors="coerce").fillna(0).astype(int).tolist(),
+        "lig": (~cats.str.contains("moto")).astype(int).tolist(),
+        "fur": cats.str.contains("furg").astype(int).tolist(),
+        "rod": cats.str.contains("rodado").astype(int).tolist(),
+    }
 
     def build_demand(kind: str) -> Callable[[int], int]:
+        values = pickup_demand.get(kind, [0] * n)
+
         def demand(index: int) -> int:
             if index < 0 or index >= manager.GetNumberOfIndices():
                 return 0
@@ -96,46 +181,36 @@ def create_demand_callbacks(
                 logger.error("⛔ IndexToNode falhou index=%s: %s", index, e)
                 return 0
 
-            if node in depot_indices:
+            if node in depots:
                 return 0
 
             pickup = node < n
             base = node if pickup else node - n
 
             if base < 0 or base >= n:
-                logger.debug("🔕 Ignorando node fora do range válido: node=%s base=%s df_len=%d", node, base, len(df))
+                logger.debug("🔕 Ignorando node fora do range válido: node=%s base=%s df_len=%d", node, base, n)
                 return 0
 
-            cat = str(df.at[base, "vehicle_category_name"]).lower() if pd.notna(df.at[base, "vehicle_category_name"]) else ""
-            ceu_val = int(df.at[base, "ceu_int"]) if pd.notna(df.at[base, "ceu_int"]) and pickup else 0
-
-            if kind == "ceu":
-                return ceu_val
-            if kind == "lig":
-                return 0 if not pickup else (0 if "moto" in cat else 1)
-            if kind == "fur":
-                return 0 if not pickup else (1 if "furg" in cat else 0)
-            if kind == "rod":
-                return 0 if not pickup else (1 if "rodado" in cat else 0)
-
-            return 0
+            return values[base] if pickup else 0
 
         return demand
 
+    # vetor por nó (depósitos / deliveries = 0): avaliado em C++, sem callback python
+    native = hasattr(routing, "RegisterUnaryTransitVector")
+    n_nodes = manager.GetNumberOfNodes()
+
     for kind in ["ceu", "lig", "fur", "rod"]:
         fn = build_demand(kind)
         demand_fns[kind] = fn
-        cb_indices[kind] = routing.RegisterUnaryTransitCallback(fn)
-
-        # if __debug__:
-        #     logger.warning("🧪 Debug manual para callback %s", kind)
-        #     for idx in range(manager.GetNumberOfIndices()):
-        #         try:
-        #             val = fn(idx)
-        #             node = manager.IndexToNode(idx)
-        #             logger.warning("🧪 %s → idx=%d, node=%d, demand=%s", kind.upper(), idx, node, val)
-        #         except Exception as e:
-        #             logger.error("⛔ Callback %s falhou para idx=%d: %s", kind, idx, e)
+        if native:
+            values = pickup_demand.get(kind, [0] * n)
+            per_node = [
+                values[node] if node < n and node not in depots else 0
+                for node in range(n_nodes)
+            ]
+            cb_indices[kind] = routing.RegisterUnaryTransitVector(per_node)
+        else:
+            cb_indices[kind] = routing.RegisterUnaryTransitCallback(fn)
 
     return cb_indices, demand_fns
 
@@ -242,22 +317,15 @@ def selecionar_subconjunto_compativel(df: pd.DataFrame, trailer_cap_ceu: int) ->
       - df_ok: veículos a usar nesta volta
       - df_pendentes: restantes
     """
-    df = df.copy()
-    df = df.sort_values(by="ceu_int", ascending=False).reset_index(drop=True)
+    # ordenação + carga acumulada só sobre o array CEU; o df é recortado uma vez por parte
+    ceu_arr = df["ceu_int"].to_numpy(dtype=np.int64)
+    order = np.argsort(-ceu_arr, kind="stable")
+    # o prefixo aceite acaba no 1.º que excede a capacidade
+    excede = np.cumsum(ceu_arr[order]) > trailer_cap_ceu
+    n_ok = int(excede.argmax()) if excede.any() else len(df)
 
-    carga_total = 0
-    indices_ok = []
-
-    for i, row in df.iterrows():
-        ceu = int(row["ceu_int"])
-        if carga_total + ceu <= trailer_cap_ceu:
-            carga_total += ceu
-            indices_ok.append(i)
-        else:
-            break
-
-    df_ok = df.loc[indices_ok].reset_index(drop=True)
-    df_restante = df.drop(indices_ok).reset_index(drop=True)
+    df_ok = df.iloc[order[:n_ok]].reset_index(drop=True)
+    df_restante = df.iloc[order[n_ok:]].reset_index(drop=True)
 
     return df_ok, df_restante        
 
@@ -279,9 +347,7 @@ def add_distance_penalty(
     """
     DIM = "DIST"
 
-    cb_idx = routing.RegisterTransitCallback(
-        lambda i, j: safe_dist_lookup(dist_matrix, manager, i, j)
-    )
+    cb_idx = register_distance_transit(routing, manager, dist_matrix)
 
     routing.AddDimension(
         cb_idx,
@@ -2,31 +2,57 @@
 from ortools.constraint_solver import pywrapcp
 from typing import List, Tuple, Dict, Any, Union
 import logging
-import unicodedata
 import math
 import os
 import httpx
 from sqlalchemy import insert
 from backend.solver.distance import register_coords, _norm
+import numpy as np
 import pandas as pd
 
 
 logger = logging.getLogger(__name__)
 
+# atributo escondido no manager com o NodeToIndex pré-calculado
+_NODE_IDX_TAG = "_node_to_index"
+
+
+def node_index_array(manager: pywrapcp.RoutingIndexManager) -> List[int]:
+    """
+    NodeToIndex de todos os nós, calculado uma vez e guardado no próprio manager.
+    Evita atravessar a fronteira Python/C++ em cada consulta dos loops de setup.
+    """
+    cached = getattr(manager, _NODE_IDX_TAG, None)
+    if cached is None:
+        to_index = manager.NodeToIndex
+        cached = [to_index(node) for node in range(manager.GetNumberOfNodes())]
+        setattr(manager, _NODE_IDX_TAG, cached)
+    return cached
+
 
 def extract_routes(
     routing: pywrapcp.RoutingModel,
     manager: pywrapcp.RoutingIndexManager,
     solution,
 ) -> List[Tuple[int, List[int]]]:
+    """
+    (veículo, [nós]) de cada rota não vazia.
+    NextVar/IndexToNode lidos uma vez por índice; o percurso é só indexação de listas.
+    """
+    size = routing.Size()  # índices >= Size() são os End dos veículos
+    next_var = routing.NextVar
+    value = solution.Value
+    to_node = manager.IndexToNode
+    nexts = [value(next_var(i)) for i in range(size)]
+    node_of = [to_node(i) for i in range(size)]
+
     rotas = []
     for v in range(routing.vehicles()):
         idx = routing.Start(v)
         path = []
-        while not routing.IsEnd(idx):
-            node = manager.IndexToNode(idx)
-            path.append(node)
-            idx = solution.Value(routing.NextVar(idx))
+        while idx < size:
+            path.append(node_of[idx])
+            idx = nexts[idx]
         if path:
             rotas.append((v, path))
     return rotas
@@ -46,6 +72,10 @@ def extract_solution(
         rotas = extract_routes(routing, manager, solution)
         logger.info(f"✅ Total de rotas extraídas: {len(rotas)}")
 
+        # colunas resolvidas uma vez: acesso escalar ao array em vez de df.iloc[...] por paragem
+        campos = {"service_reg": "service_reg", "matricula": "matricula", "cidade": "load_city", "id": "id"}
+        colunas = {k: (df[c].to_numpy() if c in df.columns else None) for k, c in campos.items()}
+
         for v, caminho in rotas:
             for ordem, solver_idx in enumerate(caminho):
                 if solver_idx not in df_idx_map:
@@ -53,15 +83,9 @@ def extract_solution(
                     continue
 
                 df_idx = df_idx_map[solver_idx]
-                row = df.iloc[df_idx]
-                reg = {
-                    "veiculo": v,
-                    "ordem": ordem,
-                    "service_reg": row.get("service_reg"),
-                    "matricula": row.get("matricula"),
-                    "cidade": row.get("load_city"),
-                    "id": row.get("id"),
-                }
+                reg = {"veiculo": v, "ordem": ordem}
+                for k, arr in colunas.items():
+                    reg[k] = arr[df_idx] if arr is not None else None
                 resultado.append(reg)
 
                 if debug:
@@ -78,25 +102,30 @@ def extract_solution(
     return resultado
 
 
-def norm(texto: str) -> str:
-    if not isinstance(texto, str) or not texto.strip():
-        return "DESCONHECIDA"
-
-    texto_normalizado = unicodedata.normalize("NFKD", texto)
-    ascii_texto = texto_normalizado.encode("ASCII", "ignore").decode()
-    texto_maiusculo = ascii_texto.upper().strip()
-
-    # Redundante após normalização, mas mantido para casos específicos
-    return (
-        texto_maiusculo
-        .replace("Á", "A")
-        .replace("Ã", "A")
-        .replace("É", "E")
-        .replace("Í", "I")
-        .replace("Ó", "O")
-        .replace("Ú", "U")
-        .replace("Ç", "C")
+# a mesma normalização (e o mesmo lru_cache) de distance._norm
+norm = _norm
+
+
+def norm_series(s: pd.Series) -> pd.Series:
+    """
+    Versão vetorizada de norm() para uma coluna inteira (acessor .str do pandas).
+    Normaliza apenas os valores distintos e propaga pelos códigos do factorize.
+    """
+    codes, uniq = pd.factorize(s)
+    out = (
+        pd.Series(uniq, dtype=object)
+        .astype("string")
+        .str.normalize("NFKD")
+        .str.encode("ascii", "ignore")
+        .str.decode("ascii")
+        .str.upper()
+        .str.strip()
+        .fillna("")
     )
+    normed = out.where(out != "", "DESCONHECIDA").to_numpy(dtype=object)
+    # código -1 (NaN) → último elemento = DESCONHECIDA
+    normed = np.append(normed, "DESCONHECIDA")
+    return pd.Series(normed[codes], index=s.index, dtype=object)
 
 
 def haversine_km(a: Tuple[float, float], b: Tuple[float, float]) -> float: